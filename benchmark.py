@@ -0,0 +1,193 @@
+from print_colors import colors as col
+import main
+import os
+import random
+import shutil
+import argparse
+import tempfile
+import time
+import zipfile
+import io
+from concurrent.futures import ThreadPoolExecutor
+
+# Benchmark of the whole grading pipeline, on generated submissions and tests
+# Everything is generated in a scratch directory, which then becomes the working directory of main.py
+# The phases that need SWI-Prolog are skipped if swipl can not be found
+
+# PATH CONSTANTS
+REPO_PATH = os.path.dirname(os.path.abspath(__file__))
+EXERCISE = "BenchEx"
+
+
+# Generates the knowledge of a single group: facts, a predicate that answers the tests,
+# and some rules to make the knowledge base large
+# Wrong groups give a wrong answer for every tenth test case
+def make_knowledge(facts, cases, wrong, rng):
+    lines = ["% Generated submission", ""]
+    lines += [f"fact({i}, {rng.randint(0, 1000)})." for i in range(facts)]
+    lines += [""]
+    lines += [f"rule_{i}(X, Y) :- fact(X, A), fact(Y, B), A + B > {i}." for i in range(facts // 10)]
+    lines += [""]
+    for i in range(cases):
+        answer = i * 2 + (1 if wrong and i % 10 == 0 else 0)
+        lines.append(f"answer({i}, {answer}).")
+    lines += ["", "double(N, M) :- answer(N, M)."]
+    return "\n".join(lines) + "\n"
+
+
+# Generates a tests.txt with the given number of test cases, every fifth test case is put in an optional group
+def make_tests_file(cases):
+    lines = ["# Generated tests", "#NAME\t\tGOAL\t\tTYPE\t\tEXPECTED", ""]
+    in_group = False
+    for i in range(cases):
+        if i % 5 == 0 and not in_group and i + 1 < cases:
+            lines.append(f"GROUP: group_{i}")
+            in_group = True
+        lines.append(f"case_{i}\t\tdouble({i}, <TVAR:X>)\t\tquery\t\tX={i * 2}")
+        if in_group and i % 5 == 1:
+            lines.append("--")
+            in_group = False
+    if in_group:
+        lines.append("--")
+    return "\n".join(lines) + "\n"
+
+
+# Writes a zip file with the given members, a member whose contents is a dictionary becomes a nested zip file
+def make_zip(members):
+    data = io.BytesIO()
+    with zipfile.ZipFile(data, "w", zipfile.ZIP_DEFLATED) as zip_file:
+        for name, contents in members.items():
+            if isinstance(contents, dict):
+                contents = make_zip(contents)
+            zip_file.writestr(name, contents)
+    return data.getvalue()
+
+
+# Generates the tests, test templates and brightspace style submission folders in the given directory
+# Submissions are spread over plain files, zip files and zip files inside zip files
+def generate_corpus(path, groups, cases, facts, seed):
+    rng = random.Random(seed)
+    shutil.copytree(os.path.join(REPO_PATH, main.TEST_TEMPLATES_PATH), os.path.join(path, main.TEST_TEMPLATES_PATH))
+
+    test_path = os.path.join(path, main.TESTS_PATH, EXERCISE)
+    os.makedirs(test_path)
+    with open(os.path.join(test_path, "tests.txt"), "w") as file:
+        file.write(make_tests_file(cases))
+    with open(os.path.join(test_path, "pre.pl"), "w") as file:
+        file.write("double(N, M) :- N=placeholder, M=placeholder.\n")
+
+    for group in range(groups):
+        # Brightspace folder names look like "<id> - <assignment> - <group> - <date>"
+        folder = os.path.join(path, main.ASSIGNMENTS_PATH,
+                              f"{100000 + group} - Assignment - Group {group} - Oct 17, 2026 1200 PM")
+        os.makedirs(folder)
+        knowledge = make_knowledge(facts, cases, group % 3 == 0, rng)
+        facts_part, _, rules_part = knowledge.partition("\n\n")
+
+        if group % 3 == 0:
+            with open(os.path.join(folder, "solution.pl"), "w") as file:
+                file.write(knowledge)
+        elif group % 3 == 1:
+            with open(os.path.join(folder, "submission.zip"), "wb") as file:
+                file.write(make_zip({"facts.pl": facts_part, "rules.pl": rules_part}))
+        else:
+            with open(os.path.join(folder, "submission.zip"), "wb") as file:
+                file.write(make_zip({"readme.txt": "Nested", "inner.zip": {"src/facts.pl": facts_part,
+                                                                         "src/rules.pl": rules_part}}))
+
+        assert main.get_group_name_brightspace(folder) != "INVALID_FOLDER_NAME"
+
+
+# Runs a function and returns its result and how long it took
+def timed(function, *args):
+    start = time.perf_counter()
+    result = function(*args)
+    return result, time.perf_counter() - start
+
+
+def benchmark(options):
+    results = []
+    scratch = tempfile.mkdtemp(prefix="prolog_bench_")
+    old_cwd = os.getcwd()
+    try:
+        _, duration = timed(generate_corpus, scratch, options.groups, options.cases, options.facts, options.seed)
+        results.append(("generate corpus", duration, ""))
+        os.chdir(scratch)
+
+        # main.py takes its settings from the commandline, so they are set up the same way
+        main.options = argparse.Namespace(jobs=options.jobs, no_pool=False, no_cache=True, results="", no_results=True,
+                                          incremental=False, profile=False, test_timeout=5, exercise_timeout=60)
+        main.init_test_templates()
+        main.init_manifest()
+
+        # Finding and reading submissions, main.py reads the knowledge of a group while grading it
+        group_names, duration = timed(lambda: list(main.read_assignments()))
+        results.append(("read_assignments", duration, f"{len(group_names) / duration:.1f} groups/s"))
+        knowledge, duration = timed(lambda: [main.read_knowledge(main.assignments[group_name].assignment_path)[0]
+                                             for group_name in group_names])
+        results.append(("read_knowledge", duration, f"{len(group_names) / duration:.1f} groups/s"))
+
+        # Parsing and compiling tests
+        tests_file = os.path.join(main.TESTS_PATH, EXERCISE, "tests.txt")
+        test_groups, duration = timed(main.read_test_file, tests_file)
+        results.append(("read_test_file", duration, f"{options.cases / duration:.0f} test cases/s"))
+
+        test = main.Test(test_groups, test_timeout=5, exercise_timeout=60, name=EXERCISE)
+        with open(os.path.join(main.TESTS_PATH, EXERCISE, "pre.pl")) as file:
+            test.pre = file.read()
+        _, duration = timed(main.compile_test, test)
+        results.append(("compile_test", duration, f"{options.cases / duration:.0f} test cases/s"))
+        test.fingerprint = main.test_fingerprint(test)
+        main.tests[EXERCISE] = test
+
+        if shutil.which("swipl") is None:
+            results.append(("grading", 0, "skipped, swipl not found"))
+            return results
+
+        _, duration = timed(main.init_prolog_pool)
+        results.append(("start workers", duration, f"{options.jobs} workers"))
+
+        # A single run of swipl on the knowledge of the first group
+        _, duration = timed(main.run_prolog, main.PrologJob(knowledge=knowledge[0], stack_limit="1m", time_limit=60))
+        results.append(("run_prolog", duration, "knowledge check of one group"))
+
+        # A single group through process_hand_in
+        main.log_buffer.lines = []
+        _, duration = timed(main.process_hand_in, group_names[0], EXERCISE, test, knowledge[0])
+        main.log_buffer.lines = None
+        results.append(("process_hand_in", duration, f"{options.cases / duration:.0f} tests/s"))
+
+        # All groups, the same way main() does it
+        def grade_all():
+            with ThreadPoolExecutor(max_workers=options.jobs) as executor:
+                return list(executor.map(main.grade_group, group_names))
+        _, duration = timed(grade_all)
+        results.append(("grade all groups", duration,
+                        f"{len(group_names) * options.cases / duration:.0f} tests/s, "
+                        f"{len(group_names) * 60 / duration:.1f} groups/min"))
+        return results
+    finally:
+        main.clean_up()
+        os.chdir(old_cwd)
+        if options.keep:
+            print(f"Generated files kept in {scratch}")
+        else:
+            shutil.rmtree(scratch, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmarks the grading pipeline on generated submissions and tests")
+    parser.add_argument("--groups", type=int, default=30, help="number of submissions to generate (default: 30)")
+    parser.add_argument("--cases", type=int, default=2000, help="number of test cases to generate (default: 2000)")
+    parser.add_argument("--facts", type=int, default=5000,
+                        help="number of facts in every submission (default: 5000)")
+    parser.add_argument("-j", "--jobs", type=int, default=1, help="number of groups to grade in parallel (default: 1)")
+    parser.add_argument("--seed", type=int, default=0, help="seed for the generated submissions (default: 0)")
+    parser.add_argument("--keep", action="store_true", help="keep the generated files")
+    bench_options = parser.parse_args()
+
+    print(f"Benchmarking {bench_options.groups} groups, {bench_options.cases} test cases and "
+          f"{bench_options.facts} facts per submission...")
+    for phase, seconds, note in benchmark(bench_options):
+        print(f"{phase:<25}{seconds:>10.3f}s   {note}")
+    print(col.OKGREEN, "Benchmark finished", col.ENDC)
@@ -0,0 +1,136 @@
+import json
+import threading
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+
+# SETTINGS
+MAX_UPLOAD_SIZE = 50 * 1024 ** 2    # Bytes a single request may send
+
+# A submission to grade, either a path to a folder or zip file on this machine, or the data of an uploaded zip file
+# exercises is the list of exercises to grade it for, empty for all of them
+Submission = namedtuple("Submission", ["name", "path", "data", "exercises"], defaults=[None, None, []])
+
+
+# Raised by the grade function for a submission that can not be graded, the client gets the message back
+class SubmissionError(Exception):
+    pass
+
+
+# Grades submissions sent to a local HTTP endpoint, with at most jobs of them being graded at the same time
+# At most queue_size more wait for their turn, anything beyond that is turned away until there is room again
+# grade is called with a Submission, and returns something JSON can represent
+#
+# POST /grade   with a JSON body {"path": ..., "name": ..., "exercises": [...]}, where only the path is needed,
+#               or with the zip file itself as body (Content-Type: application/zip),
+#               and the name and exercises in the query string (?name=...&exercise=Ex1&exercise=Ex2)
+# GET /status   tells how many submissions are being graded, are waiting and were graded so far
+class GradingServer:
+    def __init__(self, host, port, grade, jobs=1, queue_size=100):
+        self.grade = grade
+        self.executor = ThreadPoolExecutor(max_workers=jobs)
+        self.slots = threading.BoundedSemaphore(jobs + queue_size)
+        self.lock = threading.Lock()
+        self.jobs = jobs
+        self.pending = 0
+        self.graded = 0
+        self.uploads = 0
+        self.http = ThreadingHTTPServer((host, port), make_handler(self))
+
+    # Grades a submission once there is a free job, returns None if there is no room left in the queue
+    def submit(self, submission):
+        if not self.slots.acquire(blocking=False):
+            return None
+        try:
+            with self.lock:
+                self.pending += 1
+            return self.executor.submit(self.grade, submission).result()
+        finally:
+            with self.lock:
+                self.pending -= 1
+                self.graded += 1
+            self.slots.release()
+
+    def status(self):
+        with self.lock:
+            return {"grading": min(self.pending, self.jobs), "waiting": max(0, self.pending - self.jobs),
+                    "graded": self.graded}
+
+    # A name for an uploaded submission that didn't get one
+    def upload_name(self):
+        with self.lock:
+            self.uploads += 1
+            return f"upload_{self.uploads}"
+
+    def serve_forever(self):
+        self.http.serve_forever()
+
+    def close(self):
+        self.http.server_close()
+        self.executor.shutdown()
+
+
+# Creates the class handling the requests for a server
+def make_handler(server):
+    class GradingHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if urlparse(self.path).path != "/status":
+                return self.reply(404, {"error": "not found"})
+            self.reply(200, server.status())
+
+        def do_POST(self):
+            url = urlparse(self.path)
+            if url.path != "/grade":
+                return self.reply(404, {"error": "not found"})
+
+            try:
+                submission = self.read_submission(parse_qs(url.query))
+            except SubmissionError as e:
+                return self.reply(400, {"error": str(e)})
+
+            try:
+                result = server.submit(submission)
+            except SubmissionError as e:
+                return self.reply(400, {"error": str(e)})
+            except Exception as e:
+                return self.reply(500, {"error": f"grading failed: {e}"})
+            if result is None:
+                return self.reply(503, {"error": "too many submissions waiting, try again later"})
+            self.reply(200, result)
+
+        def read_submission(self, query):
+            length = int(self.headers.get("Content-Length") or 0)
+            if length > MAX_UPLOAD_SIZE:
+                raise SubmissionError(f"submission is larger than {MAX_UPLOAD_SIZE} bytes")
+            body = self.rfile.read(length)
+
+            if self.headers.get_content_type() == "application/zip":
+                name = query.get("name", [""])[0] or server.upload_name()
+                return Submission(name, data=body, exercises=query.get("exercise", []))
+
+            try:
+                request = json.loads(body)
+            except ValueError:
+                raise SubmissionError("expected a JSON body or a zip file")
+            if not isinstance(request, dict) or not isinstance(request.get("path"), str):
+                raise SubmissionError("expected a JSON object with a path")
+            exercises = request.get("exercises", [])
+            if not isinstance(exercises, list) or not all(isinstance(exercise, str) for exercise in exercises):
+                raise SubmissionError("exercises should be a list of exercise names")
+            return Submission(str(request.get("name") or request["path"]), path=request["path"],
+                              exercises=exercises)
+
+        def reply(self, status, data):
+            body = json.dumps(data, ensure_ascii=False).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        # Requests are not logged one by one, the grading itself already is
+        def log_message(self, format, *args):
+            pass
+
+    return GradingHandler
@@ -0,0 +1,55 @@
+import json
+import os
+import tempfile
+import threading
+
+
+# Keeps an entry for every (group, exercise) pair in memory, and writes them to a JSON file as a whole when saved
+# Several processes may share the file, each of them only writes the entries it changed since it last saved over
+# what is in the file, so the entries of the others are kept
+# Saving is not locked between processes: when two of them save at the same moment, the changes of the one that reads
+# the file first can be lost, which only costs some work the next time
+class MergedJsonStore:
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.entries = read_entries(path)
+        self.changed = {}
+
+    # Returns the entry of a group and exercise, or None if there is none
+    def get(self, group, exercise):
+        with self.lock:
+            return self.entries.get(group, {}).get(exercise)
+
+    def put(self, group, exercise, entry):
+        with self.lock:
+            self.entries.setdefault(group, {})[exercise] = entry
+            self.changed.setdefault(group, {})[exercise] = entry
+
+    def save(self):
+        with self.lock:
+            if not self.changed:
+                return
+            entries = read_entries(self.path)
+            for group in self.changed:
+                entries.setdefault(group, {}).update(self.changed[group])
+
+            # A temporary file of its own, so that other processes saving at the same time never write to it
+            handle, temp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(self.path)), suffix=".tmp")
+            try:
+                with open(handle, "w", encoding="utf-8") as file:
+                    json.dump(entries, file, indent=1, sort_keys=True)
+                os.replace(temp_path, self.path)
+            except BaseException:
+                os.remove(temp_path)
+                raise
+            self.changed = {}
+
+
+# Reads the entries of a store file, there are none if it doesn't exist (yet)
+def read_entries(path):
+    try:
+        with open(path, "r", encoding="utf-8") as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return {}
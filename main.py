@@ -1,61 +1,205 @@
 from subprocess import *
 from print_colors import colors as col
+from prolog_pool import WorkerPool, PrologJob, PrologResult, kill_timeout, parse_size, SWIPL, TIME_LIMIT_ERROR, \
+    WORKER_ERROR
+import json
+from result_cache import ResultCache, make_key
+from results_store import ResultsStore
+from profiler import Profiler
+from manifest import Manifest
+from run_times import RunTimes
+from grading_server import GradingServer, SubmissionError
+from work_queue import WorkQueue, job_id
+from prolog_source import normalize_source, LineMap
 import os
 import re
-from glob import glob
+from glob import glob, escape as glob_escape
+import shutil
 import platform
+import hashlib
 import zipfile
+import argparse
+import io
+import tempfile
+import threading
+import time
 from collections import namedtuple
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from concurrent.futures import ThreadPoolExecutor, Future
 
 # PATH CONSTANTS
 TESTS_PATH = "tests"
 TEST_TEMPLATES_PATH = "test_templates"
 ASSIGNMENTS_PATH = "assignments"
+CACHE_PATH = "cache"
+COMPILED_TESTS_PATH = "compiled_tests"
+RESULTS_PATH = "results.jsonl"
+MANIFEST_PATH = "manifest.json"
+RUN_TIMES_PATH = "run_times.json"
+
+# SETTINGS
+USE_WORKER_POOL = True  # Run everything through long-lived swipl workers instead of one swipl process per run
+USE_SESSIONS = True     # Load the knowledge of a group once on its worker, instead of once for every run
+USE_RESULT_CACHE = True # Reuse the results of earlier runs for unchanged submissions and tests
+CACHE_SIZE = 100 * 1024 ** 2    # Bytes the result cache may take up, the least recently used results go first
+CACHEABLE_RESULTS = ["pass", "fail"]    # Only these outcomes are cached, others (like timeouts) may be a fluke
+PROLOG_EXTENSIONS = [".pl", ".pro"]     # Files in a submission with these extensions are read as prolog
+GOAL_SUCCESS_TYPES = ["query", "query_rev", "exists"]   # Test types that can only pass if their goal succeeds
+USE_DEDUPLICATION = True    # Grade identical submissions once, and copy the results to every group that handed them in
+USE_COST_SCHEDULING = True  # Grade the groups that are expected to take longest first, so no job is left waiting on one at the end
+SERVER_HOST = "127.0.0.1"   # Address the grading service listens on, only this machine by default
+SERVER_QUEUE_SIZE = 100     # Number of submissions that may wait to be graded by the grading service
+
+# PATTERNS
+TAB_PATTERN = re.compile(r"\t")                    # Separates the columns of a test
+TVAR_PATTERN = re.compile(r"<TVAR:([A-Z]\w*)>")     # A test variable in a test goal, captures its name
+WRITE_PATTERN = re.compile(r"\b(write|writeln)\(")   # A write in a test template, captures the predicate name
+SEPARATOR_PATTERN = re.compile(r"""\bwrite(?:ln)?\(\s*(["'])\|:\|\1\s*\)""")  # A write of |:| in a test template
+VALUE_PATTERN = re.compile(r"<VALUE:([A-Z]\w*)>")   # An expected value in a test template, captures its variable
+CALL_PATTERN = re.compile(r"([a-z]\w*)(?:\((.*)\))?", re.DOTALL)  # A plain call in a goal, captures name and arguments
+# Where swipl says an error in the knowledge is, captures the line and column
+KNOWLEDGE_LOCATION_PATTERN = re.compile(r"(?:\S*knowledge\.temp|job_\w+_knowledge|(?:Stream )?<stream>\(\w+\)):(\d+):(\d+)")
+
+# PROLOG
+# Every compiled test starts with this
+# Test cases write their results through checker_write/1 and checker_writeln/1, which collect the written strings
+# They separate the values they write with checker_separator/0, which is reported as null
+# Once a test case is done, checker_run/2 reports what it wrote and the seconds it took through checker_report/3,
+# which is defined by whoever runs the test (see prolog_worker.pl and REPORT_SOURCE)
+# That way anything else that is written, like the output of a submission, can't end up in the results
+TEST_SOURCE_HEADER = """checker_run(Id, Query) :-
+    nb_setval(checker_output, []),
+    get_time(Start),
+    once(Query),
+    get_time(End),
+    Duration is End - Start,
+    nb_getval(checker_output, Written),
+    reverse(Written, Output),
+    checker_report(Id, Output, Duration).
+
+checker_write(X) :-
+    format(string(S), "~w", [X]),
+    nb_getval(checker_output, Written),
+    nb_setval(checker_output, [S|Written]).
+
+checker_writeln(X) :-
+    format(string(S), "~w~n", [X]),
+    nb_getval(checker_output, Written),
+    nb_setval(checker_output, [S|Written]).
+
+checker_separator :-
+    nb_getval(checker_output, Written),
+    nb_setval(checker_output, [null|Written]).
+
+% Runs Query within Limits: a list of inference_limit(N), stack_limit-Bytes and table_space-Bytes
+% Running out of any of them, or out of any other resource, only ends this test case, as "resource"
+checker_limit(Query, Limits) :-
+    catch(checker_limit_(Limits, Query), error(resource_error(Resource), _), checker_exceeded(Resource)).
+
+checker_limit_([], Query) :-
+    call(Query).
+checker_limit_([inference_limit(N)|Limits], Query) :-
+    call_with_inference_limit(checker_limit_(Limits, Query), N, Result),
+    (   Result == inference_limit_exceeded
+    ->  checker_exceeded(inferences)
+    ;   true
+    ).
+checker_limit_([Flag-Value|Limits], Query) :-
+    current_prolog_flag(Flag, Old),
+    setup_call_cleanup(set_prolog_flag(Flag, Value), checker_limit_(Limits, Query), set_prolog_flag(Flag, Old)).
+
+% Whatever the test case wrote so far is replaced by the resource it ran out of
+checker_exceeded(Resource) :-
+    nb_setval(checker_output, []),
+    checker_write("Resource limit exceeded: "),
+    checker_write(Resource),
+    checker_separator,
+    checker_writeln(resource).
+
+"""
+
+# Reports test cases in a commandline run of swipl, every report is a JSON line in results.temp
+REPORT_SOURCE = """:- use_module(library(http/json)).
+
+checker_report(Id, Output, Duration) :-
+    setup_call_cleanup(open('results.temp', append, Stream, [encoding(utf8)]),
+                       (json_write_dict(Stream, _{id:Id, output:Output, duration:Duration}, [width(0)]), nl(Stream)),
+                       close(Stream)).
+"""
+LIMIT_KEYS = {          # Limits on a single test case, set per exercise in config.txt or per test case in tests.txt
+    "test_timeout": float,
+    "inference_limit": int,
+    "stack_limit": parse_size,
+    "table_space": parse_size,
+}
+CONFIG_KEYS = {         # Settings that can be overridden per exercise in config.txt, and their types
+    "exercise_timeout": float,
+    **LIMIT_KEYS,
+}
 
 # FIELDS
 test_templates = {}     # Stores the prolog query templates that are used in the tests
 tests = {}              # Keys: Folder name where the test resides, Values: a Test instance (see class Test)
-assignments = {}        # Keys: Group names, extracted from group folders, Values: Concatenated knowledge of prolog files
-shell_command = []      # Stores the shell command to be used, depends on system (only Windows supported for now)
+assignments = {}        # Keys: Group names, extracted from group folders, Values: an Assignment (see read_assignments)
+swipl_command = SWIPL   # The swipl executable that is run for every run outside of the workers
+prolog_pool = None      # The pool of swipl workers, if USE_WORKER_POOL is enabled
+result_cache = None     # The cache of earlier test results, if USE_RESULT_CACHE is enabled
+results_store = None    # Where a record of every test case result is written to, unless disabled
+run_id = None           # When this run started (UTC) and who ran it, included in the records to tell runs apart
+profiler = None         # Collects the timings of all runs of swipl, if profiling is enabled
+manifest = None         # Fingerprints of the inputs every group and exercise was last graded with
+run_times = None        # How long every group and exercise took to grade the last time, not kept in service mode
+options = None          # The parsed commandline arguments
+worker_name = None      # Name of this process among the processes that grade the same groups, with --shard or --queue
+output_lock = threading.Lock()  # Keeps the output of groups that are printed as soon as they're graded apart
+graded_knowledge = {}   # Keys: knowledge fingerprints, Values: a Future of the GradedKnowledge of the first group with it
+knowledge_groups = {}   # Keys: knowledge fingerprints, Values: the names of all groups that handed in that knowledge
+knowledge_lock = threading.Lock()   # Guards graded_knowledge and knowledge_groups
+log_buffer = threading.local()  # Collects the output of the group that is being graded by the current thread
+group_worker = threading.local()    # The swipl worker reserved for the group that is being graded by the current thread
+current_group = threading.local()   # The name of the group that is being graded by the current thread
 
 # CLASSES
-class TestCase:
-    result = ''
-    success = "unknown"
+Assignment = namedtuple("Assignment", ["assignment_path"])    # Its knowledge is only read while it is graded
+Goal = namedtuple("Goal", ["goal", "vars"])     # A test goal and its test variables
 
-    def __init__(self, name, type, goal, expected):
-        self.name = name
-        self.type = type
-        self.goal = goal
-        self.expected = expected
+# A test case as read from a test file, shared by all groups
+# limits are the limits of this test case that override those of its test (see LIMIT_KEYS),
+# predicate is the predicate that runs it in the compiled test (see compile_test)
+TestCase = namedtuple("TestCase", ["name", "type", "goal", "expected", "limits", "predicate"], defaults=[None])
 
-    def reset(self):
-        self.result = ''
-        self.success = "unknown"
-
-    def __str__(self):
-        return f"TestCase(name={self.name}, type={self.type}, goal={self.goal}, expected={self.expected}, " \
-               f"result={self.result} success={self.success})"
-
-    def __repr__(self):
-        return self.__str__()
+# The outcome of a test case for a single group: whether it passed ("pass", "fail", "timeout", ...), what the test
+# variables turned out to be, and the seconds taken by the run of swipl that produced it
+TestResult = namedtuple("TestResult", ["success", "result", "duration"], defaults=[None])
+# What grading a group's knowledge came to, results has keys: the exercises that were graded, values: their results
+GradedKnowledge = namedtuple("GradedKnowledge", ["group", "valid", "results"])
+NOT_RUN = TestResult("unknown", [])     # The outcome of a test case that didn't get to run
 
 
 class Test:
-    def __init__(self, test_groups=None, pre="", abolish=None, database=""):
+    __slots__ = ["name", "pre", "abolish", "database", "test_groups", "test_timeout", "exercise_timeout",
+                 "inference_limit", "stack_limit", "table_space", "source", "fingerprint", "required"]
+
+    def __init__(self, test_groups=None, pre="", abolish=None, database="", test_timeout=0, exercise_timeout=0,
+                 name=""):
         if test_groups is None:
             test_groups = {}
         if abolish is None:
             abolish = []
+        self.name = name        # Name of the test folder
         self.pre = pre
         self.abolish = abolish
         self.database = database
         self.test_groups = test_groups
-
-    def reset(self):
-        for test_group in self.test_groups:
-            for test_case in self.test_groups[test_group]:
-                test_case.reset()
+        self.test_timeout = test_timeout            # Seconds a single test case may take, 0 means no limit
+        self.exercise_timeout = exercise_timeout    # Seconds all runs of swipl for the exercise may take, 0 means no limit
+        self.inference_limit = 0                    # Inferences a single test case may take, 0 means no limit
+        self.stack_limit = 0                        # Bytes of stack a single test case may use, 0 means no limit
+        self.table_space = 0                        # Bytes of tables a single test case may use, 0 means no limit
+        self.source = ""                            # Prolog source running the test cases, see compile_test
+        self.fingerprint = ""                       # Hash of everything that determines the outcome of the test
+        self.required = {}                          # Predicates a submission needs to pass a test case, by test case
 
     def __str__(self):
         return f"Test(test_cases={str(self.test_groups)}, pre={self.pre}, abolish={self.abolish}, database={self.database})"
@@ -67,54 +211,462 @@ class Test:
 # MAIN
 def main():
     # Initialize resources
-    init_shell()
+    init_options()
+    init_swipl()
+    init_prolog_pool()
+    init_result_cache()
+    init_results_store()
+    init_profiler()
+    init_manifest()
+    init_run_times()
     init_test_templates()
     init_tests()
-    init_assignments()
 
-    # Iterate over the group names
-    for group_name in assignments:
-        print(f"Processing group {group_name}")
+    # In service mode, submissions are graded as they come in until the service is stopped
+    if options.serve is not None:
+        serve()
+        clean_up()
+        return
 
-        # Write the knowledge for this group to the working directory so that we may use it in the commandline calls
-        with open("knowledge.temp", "w") as file:
-            file.write(assignments[group_name].knowledge)
+    # With a work queue, the groups are graded by whoever gets to them first
+    if options.queue is not None:
+        grade_queue(list(read_assignments()))
+    else:
+        # With a shard, only the groups that belong to it are graded
+        group_names = list(read_assignments())
+        if options.shard is not None:
+            group_names = list(filter(in_shard, group_names))
+
+        # Grade the groups several at a time if requested, the groups expected to take longest are started first
+        # The output of every group is collected while it is graded, and printed in group order afterwards
+        with ThreadPoolExecutor(max_workers=options.jobs) as executor:
+            futures = {group_name: executor.submit(grade_group, group_name) for group_name in schedule(group_names)}
+            for group_name in group_names:
+                print("\n".join(futures[group_name].result()))
 
-        # Sanity check for knowledge to skip it (in case of syntax errors)
-        cmd = ['swipl -G1m -q -g consult("knowledge.temp") -t halt']
-        out = command_call(shell_command, cmd)
-        if "ERROR" in out[1]:
-            print(col.WARNING, f"Knowledge of group {group_name} contains errors, skipping test run..", col.ENDC)
-            continue
+    # Clean up any temporary files in the working directory
+    clean_up()
+
+    for line in identical_submissions():
+        print(col.WARNING, line, col.ENDC)
 
-        # Clear any previous test output files in the group's assignment folder if present
-        for f in glob(f"{assignments[group_name].assignment_path}{os.sep}*.out"):
+    if profiler is not None:
+        print("\n".join(profiler.summary()))
+
+    print("Finished running all tests on all assignments!")
+
+
+# Whether a group belongs to the shard given on the commandline, which only depends on the name of the group
+def in_shard(group_name):
+    index, count = options.shard
+    return int(hashlib.sha256(group_name.encode("utf-8")).hexdigest(), 16) % count == index - 1
+
+
+# Adds the groups to the work queue given on the commandline (unless they are in there already with the same inputs),
+# and grades the groups in the queue until there are none left, the output of every group is printed as soon as it is
+# graded
+def grade_queue(group_names):
+    work_queue = WorkQueue(options.queue, worker_name)
+    costs = expected_costs(group_names)
+    added = sum(work_queue.add(job_id(group_name), {"group": group_name, "cost": costs[group_name],
+                                                    "inputs": group_fingerprint(group_name)})
+                for group_name in schedule(group_names, costs))
+    print(f"Added {added} group(s) to the work queue in {options.queue}")
+
+    def work():
+        while True:
+            job = work_queue.claim()
+            if job is None:
+                return
+            claimed_id, data = job
+            if data["group"] in assignments:
+                group_log = grade_group(data["group"])
+            else:
+                group_log = [col.WARNING + f" Group {data['group']} was not found in {ASSIGNMENTS_PATH}, skipping it..."
+                             + col.ENDC]
+            with output_lock:
+                print("\n".join(group_log))
+            work_queue.finish(claimed_id)
+
+    with ThreadPoolExecutor(max_workers=options.jobs) as executor:
+        for future in [executor.submit(work) for _ in range(options.jobs)]:
+            future.result()
+
+
+# The fingerprint of everything grading a group depends on: its knowledge and all tests
+def group_fingerprint(group_name):
+    knowledge, _ = read_knowledge(assignments[group_name].assignment_path)
+    return make_key("inputs", knowledge, [tests[exercise].fingerprint for exercise in sorted(tests)])
+
+
+# Orders the groups so that the ones expected to take longest come first
+# A short group scheduled last only keeps a single job busy for a short while at the end, a long one the other way round
+def schedule(group_names, costs=None):
+    if not USE_COST_SCHEDULING:
+        return group_names
+    if costs is None:
+        costs = expected_costs(group_names)
+    return sorted(group_names, key=lambda group_name: -costs[group_name])
+
+
+# The number of seconds grading every group is expected to take
+# Keys: group names, values: the sum of the expected seconds of all exercises
+# An exercise that was graded before is expected to take as long as it did then, for any other the size of the
+# submission times the number of test cases is used, scaled to seconds by how long the known exercises took
+def expected_costs(group_names):
+    sizes = {group_name: submission_size(assignments[group_name].assignment_path) for group_name in group_names}
+    test_case_counts = {exercise: len(flatten(tests[exercise].test_groups.values())) for exercise in tests}
+
+    known_seconds, known_work = 0, 0
+    for group_name in group_names:
+        for exercise in tests:
+            entry = run_times.get(group_name, exercise) if run_times is not None else None
+            if entry is not None:
+                known_seconds += entry["duration"]
+                known_work += sizes[group_name] * test_case_counts[exercise]
+    seconds_per_work = known_seconds / known_work if known_seconds > 0 and known_work > 0 else 1
+
+    costs = {}
+    for group_name in group_names:
+        costs[group_name] = 0
+        for exercise in tests:
+            entry = run_times.get(group_name, exercise) if run_times is not None else None
+            if entry is not None:
+                costs[group_name] += entry["duration"]
+            else:
+                costs[group_name] += sizes[group_name] * test_case_counts[exercise] * seconds_per_work
+    return costs
+
+
+# The number of bytes of all files in the folder of a submission, zip files included as they are
+def submission_size(assignment_path):
+    size = 0
+    for directory, _, file_names in os.walk(assignment_path):
+        for file_name in file_names:
+            # The out files of earlier runs are not part of the submission
+            if file_name.endswith(".out"):
+                continue
             try:
-                os.remove(f)
-            except FileNotFoundError:
+                size += os.path.getsize(os.path.join(directory, file_name))
+            except OSError:
                 pass
+    return size
 
-        # Run the tests
-        for exercise in tests:
-            print(f"Running tests for exercise {exercise}")
-            # Write pre-knowledge and database to working directory
-            with open("pre.temp", "w") as file:
-                file.write(tests[exercise].pre)
-            with open("database.temp", "w") as file:
-                file.write(tests[exercise].database)
 
-            # Reset all tests for every group/exercise
-            tests[exercise].reset()
-            process_hand_in(group_name, exercise, tests[exercise])
+# Runs all tests for a single group, returns the output that was produced while doing so
+def grade_group(group_name):
+    log_buffer.lines = []
+    current_group.name = group_name
+    try:
+        # The knowledge is only kept in memory while the group is being graded
+        knowledge, line_map = read_knowledge(assignments[group_name].assignment_path)
+        if knowledge == "":
+            log(col.WARNING, f"Group {group_name} has no prolog files that can be tested...", col.ENDC)
+        else:
+            grade_unique_knowledge(group_name, knowledge, line_map)
+        manifest.save()
+        if run_times is not None:
+            run_times.save()
+        return log_buffer.lines
+    finally:
+        log_buffer.lines = None
+        current_group.name = None
+
+
+# Grades the knowledge of a group, unless another group in this run handed in the same knowledge
+# The first group with some knowledge grades it, any other group waits for that and copies its results
+def grade_unique_knowledge(group_name, knowledge, line_map):
+    if not USE_DEDUPLICATION:
+        with knowledge_session(knowledge):
+            grade_knowledge(group_name, knowledge, line_map)
+        return
+
+    fingerprint = make_key("knowledge", knowledge)
+    with knowledge_lock:
+        knowledge_groups.setdefault(fingerprint, []).append(group_name)
+        first = graded_knowledge.get(fingerprint)
+        if first is None:
+            graded = graded_knowledge[fingerprint] = Future()
+
+    if first is None:
+        outcome = None
+        try:
+            with knowledge_session(knowledge):
+                outcome = grade_knowledge(group_name, knowledge, line_map)
+        finally:
+            graded.set_result(outcome)
+    elif not copy_graded_knowledge(group_name, knowledge, first.result()):
+        with knowledge_session(knowledge):
+            grade_knowledge(group_name, knowledge, line_map)
+
+
+# Gives a group the results of another group that handed in the same knowledge, as if it was graded itself
+# Returns False if that is not possible, because the other group didn't grade all exercises this group needs
+# (in incremental mode, or if grading it failed)
+def copy_graded_knowledge(group_name, knowledge, outcome):
+    exercises = [exercise for exercise in tests if not is_up_to_date(group_name, exercise, knowledge)]
+    if outcome is None or outcome.valid and any(exercise not in outcome.results for exercise in exercises):
+        return False
+
+    log(f"Processing group {group_name}")
+    log(f"Group {group_name} handed in the same knowledge as group {outcome.group}, reusing its results..")
+    if not exercises:
+        log(f"Nothing changed for group {group_name} since it was last graded, skipping test run..")
+        return True
+    if not outcome.valid:
+        log(col.WARNING, f"Knowledge of group {group_name} contains errors, skipping test run..", col.ENDC)
+        return True
+
+    remove_out_files(group_name, exercises)
+    for exercise in exercises:
+        record_results(group_name, exercise, tests[exercise], [], outcome.results[exercise])
+        write_out_file(group_name, exercise, tests[exercise], outcome.results[exercise])
+        record_inputs(group_name, exercise, knowledge, outcome.results[exercise])
+    return True
 
-    # Clean up any temporary files in the working directory
-    clean_up()
 
-    print("Finished running all tests on all assignments!")
+# The groups that handed in the same knowledge as another group in this run, one line for every set of them
+def identical_submissions():
+    lines = []
+    for group_names in knowledge_groups.values():
+        if len(group_names) > 1:
+            lines.append(f"Identical submissions: {', '.join(sorted(group_names))}")
+    return sorted(lines)
+
+
+# Runs all tests on the knowledge of a single group, returns a GradedKnowledge, or None if nothing had to be graded
+def grade_knowledge(group_name, knowledge, line_map):
+    log(f"Processing group {group_name}")
+
+    # In incremental mode, exercises that were graded before with the same inputs are left alone
+    exercises = [exercise for exercise in tests if not is_up_to_date(group_name, exercise, knowledge)]
+    if not exercises:
+        log(f"Nothing changed for group {group_name} since it was last graded, skipping test run..")
+        return None
+
+    # Sanity check for knowledge to skip it (in case of syntax errors)
+    valid, defined = check_knowledge(knowledge, line_map)
+    if not valid:
+        log(col.WARNING, f"Knowledge of group {group_name} contains errors, skipping test run..", col.ENDC)
+        return GradedKnowledge(group_name, False, {})
+
+    # Clear any previous test output files in the group's assignment folder if present
+    remove_out_files(group_name, exercises)
+
+    # Run the tests
+    results = {}
+    for exercise in exercises:
+        log(f"Running tests for exercise {exercise}")
+
+        results[exercise] = process_hand_in(group_name, exercise, tests[exercise], knowledge, defined)
+        record_inputs(group_name, exercise, knowledge, results[exercise])
+    return GradedKnowledge(group_name, True, results)
+
+
+# Removes the out files of earlier runs from a group's assignment folder
+# In incremental mode, only those of the given exercises, which are graded again
+def remove_out_files(group_name, exercises):
+    assignment_path = assignments[group_name].assignment_path
+    if options.incremental:
+        out_files = flatten(glob(os.path.join(glob_escape(assignment_path), f"[+-]{glob_escape(exercise)}.out"))
+                            for exercise in exercises)
+    else:
+        out_files = glob(f"{glob_escape(assignment_path)}{os.sep}*.out")
+    for f in out_files:
+        try:
+            os.remove(f)
+        except FileNotFoundError:
+            pass
+
+
+# The fingerprint of everything a group's out file for an exercise depends on
+def input_fingerprint(knowledge, exercise):
+    return make_key("inputs", knowledge, tests[exercise].fingerprint)
+
+
+# Remembers the inputs an exercise was graded with for a group, so it isn't graded again with the same inputs
+# Only if every test case has a result that would be cached, others (like timeouts) may be a fluke and are graded again
+def record_inputs(group_name, exercise, knowledge, results):
+    test_cases = flatten(tests[exercise].test_groups.values())
+    if all(results.get(test_case.name, NOT_RUN).success in CACHEABLE_RESULTS for test_case in test_cases):
+        manifest.set(group_name, exercise, input_fingerprint(knowledge, exercise))
+    else:
+        manifest.set(group_name, exercise, None)
+
+
+# Whether an exercise was graded for a group with the same inputs before, and its out file is still there
+# Always False, unless running in incremental mode
+def is_up_to_date(group_name, exercise, knowledge):
+    if not options.incremental:
+        return False
+    if manifest.get(group_name, exercise) != input_fingerprint(knowledge, exercise):
+        return False
+    return len(glob(os.path.join(glob_escape(assignments[group_name].assignment_path),
+                                 f"[+-]{glob_escape(exercise)}.out"))) > 0
+
+
+# Reserves a worker for the current thread, which keeps the knowledge loaded for all runs in the with block
+# Does nothing if there are no workers or if sessions are disabled
+@contextmanager
+def knowledge_session(knowledge):
+    if prolog_pool is None or not USE_SESSIONS:
+        yield
+        return
+
+    with prolog_pool.worker() as worker, worker.session(knowledge):
+        group_worker.worker = worker
+        try:
+            yield
+        finally:
+            group_worker.worker = None
+
+
+# Checks whether knowledge can be loaded without errors, returns that and the set of predicates it defines
+# (None if those are unknown), the outcome is cached like test results are
+# With swipl workers the knowledge is screened first (see screen_source), which tells the predicates it defines,
+# knowledge without syntax errors is then loaded to find the errors of its directives
+# The errors are logged with the file and line they are at in the submission, found through the line map
+def check_knowledge(knowledge, line_map=None):
+    key = make_key("check", knowledge, options.exercise_timeout, prolog_pool is not None)
+    if result_cache is not None:
+        cached = result_cache.get(key)
+        if cached is not None:
+            log_knowledge_errors(cached.get("errors", []), line_map)
+            return cached["valid"], None if cached["predicates"] is None else set(cached["predicates"])
+
+    err, predicates = "", None
+    if prolog_pool is not None:
+        screened = screen_source(knowledge)
+        err, predicates = screened.err, screened.predicates if screened.complete else None
+    if "ERROR" not in err:
+        err += load_errors(knowledge)
+    valid = "ERROR" not in err
+    errors = [line for line in err.split("\n") if "ERROR" in line]
+    log_knowledge_errors(errors, line_map)
+
+    # A run that got stopped or lost its worker says nothing about the knowledge itself
+    if result_cache is not None and TIME_LIMIT_ERROR not in err and WORKER_ERROR not in err:
+        result_cache.put(key, {"valid": valid, "predicates": predicates, "errors": errors})
+    return valid, None if predicates is None else set(predicates)
+
+
+# Logs the errors swipl gave for some knowledge, a place in the knowledge is replaced by the file and line it came from
+def log_knowledge_errors(errors, line_map=None):
+    def locate(match):
+        location = line_map.locate(int(match.group(1))) if line_map is not None else None
+        if location is None:
+            return match.group()
+        path, line = location
+        return f"{path}:{line}:{match.group(2)}"
+
+    for error in errors:
+        log(col.FAIL + "\t" + KNOWLEDGE_LOCATION_PATTERN.sub(locate, error) + col.ENDC)
+
+
+# Loads knowledge the way the tests do, returns the errors that gives
+# Within a knowledge session it is loaded as the session, so the tests don't have to load it again
+def load_errors(knowledge):
+    job = PrologJob(knowledge=knowledge, stack_limit="1m", time_limit=options.exercise_timeout,
+                    profile=options.profile)
+    worker = getattr(group_worker, "worker", None)
+    if worker is not None and worker.session_knowledge == knowledge:
+        return worker.session_errors(job)
+    return run_prolog(job).err
+
+
+# Reads the terms of a source on a swipl worker without loading it, returns a ScreenResult
+# It has the syntax errors of the source and the predicates it defines, and which of the candidates
+# (predicates as "name/arity") are provided by Prolog itself
+def screen_source(source, candidates=()):
+    job = PrologJob(knowledge=source, stack_limit="1m", time_limit=options.exercise_timeout)
+    worker = getattr(group_worker, "worker", None)
+    if worker is not None:
+        return worker.screen(job, candidates)
+    return prolog_pool.screen(job, candidates)
+
+
+# Print, unless we're grading a group, in which case the output is kept until the group is done
+def log(*args):
+    lines = getattr(log_buffer, "lines", None)
+    if lines is None:
+        print(*args)
+    else:
+        lines.append(" ".join(map(str, args)))
+
+
+# Parse the commandline arguments
+def init_options():
+    global options, worker_name
+
+    parser = argparse.ArgumentParser(description="Runs the tests in the tests folder on all submissions in the "
+                                                 "assignments folder")
+    parser.add_argument("-j", "--jobs", type=int, default=1,
+                        help="number of groups to grade in parallel (default: 1)")
+    parser.add_argument("--no-pool", action="store_true",
+                        help="start a new swipl process for every run instead of using persistent workers")
+    parser.add_argument("--no-cache", action="store_true",
+                        help="run every test again, instead of reusing results of earlier runs")
+    parser.add_argument("--results", metavar="FILE",
+                        help=f"file to append a JSON record of every test result to (default: {RESULTS_PATH}, "
+                             f"or one file per shard or queue worker)")
+    parser.add_argument("--no-results", action="store_true",
+                        help="don't write the results file")
+    parser.add_argument("--incremental", action="store_true",
+                        help="only grade the exercises of groups whose submission or test changed since the last run")
+    parser.add_argument("--profile", action="store_true",
+                        help="time every step of every run of swipl, and print the slowest groups and tests at the end")
+    parser.add_argument("--test-timeout", type=float, default=5,
+                        help="seconds a single test case may take, 0 for no limit (default: 5)")
+    parser.add_argument("--exercise-timeout", type=float, default=60,
+                        help="seconds all runs of swipl for an exercise may take together, 0 for no limit (default: 60)")
+    parser.add_argument("--serve", type=int, metavar="PORT",
+                        help="keep running, and grade the submissions that are sent to http://localhost:PORT/grade")
+    spread = parser.add_mutually_exclusive_group()
+    spread.add_argument("--shard", type=parse_shard, metavar="I/N",
+                        help="only grade the groups of shard I out of N, to spread the groups over N machines")
+    spread.add_argument("--queue", metavar="DIR",
+                        help="grade the groups through a work queue in DIR, which several machines can share")
+    options = parser.parse_args()
+
+    if options.jobs < 1:
+        print(col.FAIL, "ERROR: --jobs needs to be at least 1", col.ENDC)
+        exit(1)
+    if options.test_timeout < 0 or options.exercise_timeout < 0:
+        print(col.FAIL, "ERROR: timeouts can not be negative", col.ENDC)
+        exit(1)
+
+    # Processes that grade the same groups each get a results file of their own, so they can be merged afterwards
+    # (see merge_results.py)
+    if options.shard is not None:
+        worker_name = f"shard{options.shard[0]}of{options.shard[1]}"
+    elif options.queue is not None:
+        worker_name = f"{platform.node()}-{os.getpid()}"
+    if options.results is None:
+        base, extension = os.path.splitext(RESULTS_PATH)
+        options.results = RESULTS_PATH if worker_name is None else f"{base}.{worker_name}{extension}"
+
+
+# Reads a shard given as "i/N", with 1 <= i <= N
+def parse_shard(text):
+    index, _, count = text.partition("/")
+    try:
+        index, count = int(index), int(count)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid shard {text}, expected I/N like 1/4")
+    if not 1 <= index <= count:
+        raise argparse.ArgumentTypeError(f"invalid shard {text}, I has to be between 1 and N")
+    return index, count
 
 
-# Remove all left-over files
+# Remove all left-over files, stop the swipl workers and shrink the result cache if it grew too large
 def clean_up():
+    if prolog_pool is not None:
+        prolog_pool.close()
+    if result_cache is not None:
+        result_cache.evict()
+    if results_store is not None:
+        results_store.close()
+
     # Cleaning up temporary files created in the process
     for t in glob("*.temp"):
         try:
@@ -123,24 +675,66 @@ def clean_up():
             pass
 
 
-# Assign the proper shell command according to the OS
-def init_shell():
-    global shell_command
+# Find the swipl executable, it is started directly on every OS, without a shell in between
+def init_swipl():
+    global swipl_command
 
-    # Identify the shell we're running on (just informative for now)
-    try:
-        print("Current shell:", os.environ['SHELL'])
-    except KeyError:
-        print("Not running from shell currently")
-
-    # Assign the shell command
-    # TODO: implement bash support and possibly support for other shells where SWI-Prolog can be used
-    if platform.system() == 'Windows':
-        print("Using cmd as shell...")
-        shell_command = [r'cmd', r'/C']
-    else:
-        print("No available and supported shell found!")
+    swipl_command = shutil.which(SWIPL)
+    if swipl_command is None:
+        print(col.FAIL, f"ERROR: {SWIPL} could not be found, please make sure SWI-Prolog is on the PATH", col.ENDC)
         exit(1)
+    print("Using SWI-Prolog at", swipl_command)
+
+
+# Start the swipl workers, if enabled
+def init_prolog_pool():
+    global prolog_pool
+
+    if USE_WORKER_POOL and not options.no_pool:
+        print(f"Starting {options.jobs} SWI-Prolog worker(s)...")
+        prolog_pool = WorkerPool(options.jobs)
+
+
+# Open the result cache, if enabled
+def init_result_cache():
+    global result_cache
+
+    if USE_RESULT_CACHE and not options.no_cache:
+        result_cache = ResultCache(CACHE_PATH, CACHE_SIZE)
+
+
+# Open the results file, if enabled
+def init_results_store():
+    global results_store, run_id
+
+    # Sorts by the time the run started, also between machines in other time zones, then by the process that ran it
+    started = datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%S.%fZ")
+    run_id = f"{started} {worker_name or f'{platform.node()}-{os.getpid()}'}"
+    if not options.no_results:
+        results_store = ResultsStore(options.results)
+
+
+# Start collecting timings, if enabled
+def init_profiler():
+    global profiler
+
+    if options.profile:
+        profiler = Profiler()
+
+
+# Read the fingerprints of the previous runs
+def init_manifest():
+    global manifest
+
+    manifest = Manifest(MANIFEST_PATH)
+
+
+# Read how long grading took on previous runs, not needed in service mode
+def init_run_times():
+    global run_times
+
+    if options.serve is None:
+        run_times = RunTimes(RUN_TIMES_PATH)
 
 
 # Initialize the test template files
@@ -148,98 +742,137 @@ def init_test_templates():
     global test_templates
 
     # Reads and stores template files according to name
-    for ttn in [q.split("\\")[1] for q in glob(f"{TEST_TEMPLATES_PATH}{os.sep}*")]:
+    for ttn in map(os.path.basename, glob(f"{TEST_TEMPLATES_PATH}{os.sep}*")):
         with open(os.path.join(TEST_TEMPLATES_PATH, ttn), "r") as file:
             test_templates[ttn] = file.read()
 
 
-# Read a test file containing test cases, constructing a Test instance
-# TODO: Too long and complicated, requires refactor
+# Read a test file containing test cases, returns its test groups (keys: group names, values: lists of test cases)
+# Every error in the file is reported with its line number, after which the program stops
+# Parsed test files are kept in the result cache, keyed on their contents
 def read_test_file(file_name):
     with open(file_name, "r") as file:
-        test_group = ""
-        test_groups = {}
-        in_group = False
+        text = file.read()
+
+    # The templates are part of the key, since they decide which expected values a test needs
+    key = make_key("suite", text, test_templates)
+    if result_cache is not None:
+        cached = result_cache.get(key)
+        if cached is not None:
+            return test_groups_from_json(cached)
+
+    test_groups, errors = parse_tests(text)
+    if errors:
+        for line_number, message in errors:
+            print(col.FAIL, f"ERROR: {file_name}, line {line_number}: {message}", col.ENDC)
+        print(col.FAIL, f"ERROR: {len(errors)} error(s) in {file_name}, please fix this!", col.ENDC)
+        exit(1)
 
-        # Go through the lines in the test file, while keeping track of whether we're in an optional group or not
-        for test_line in file.readlines():
-            # Reset the test group name if we're not in one anymore
-            if not in_group:
-                test_group = ""
-            # Comments are ignored
-            if test_line.startswith("#") or test_line.strip() == "":
+    if result_cache is not None:
+        result_cache.put(key, test_groups_to_json(test_groups))
+    return test_groups
+
+
+# Parses the contents of a test file in a single pass over its lines
+# Returns the test groups, and a list of (line number, message) for every error found
+def parse_tests(text):
+    test_groups = {}
+    names = set()
+    errors = []
+    test_group = ""     # Name of the optional group we're in, empty if we're not in one
+
+    for line_number, test_line in enumerate(text.splitlines(), 1):
+        # Comments are ignored
+        if test_line.startswith("#") or test_line.strip() == "":
+            continue
+        # Starting delimiter for optional groups
+        if test_line.startswith("GROUP"):
+            test_group = test_line.partition(":")[2].strip()
+            if not test_group:
+                errors.append((line_number, "optional group without a name"))
+            continue
+        # Ending delimiter for optional groups
+        if test_line.startswith("--"):
+            test_group = ""
+            continue
+
+        # Split test case line on tabs, strip all remaining spaces, while ignoring empty strings resulting from that
+        split_test = [x.strip() for x in TAB_PATTERN.split(test_line.strip()) if x.strip() != '']
+        if len(split_test) < 4:
+            errors.append((line_number, "a test needs a name, goal, type and expected value, separated by tabs"))
+            continue
+
+        # The first entry is the name, and the third entry is the type of test template to use
+        name, goal_str, type, expected_str = split_test[:4]
+
+        # The optional fifth entry sets limits for this test case only: <KEY1>=<VALUE1>, <KEY2>=<VALUE2>, ...
+        limits = {}
+        for x in (split_test[4] if len(split_test) > 4 else "").split(","):
+            if x.strip() == "":
+                continue
+            key, _, value = [y.strip() for y in x.partition("=")]
+            if key not in LIMIT_KEYS:
+                errors.append((line_number, f"unknown limit {key} in test {name}"))
                 continue
-            # Starting delimiter for optional groups
-            if test_line.startswith("GROUP"):
-                test_group = test_line.split(":")[1].strip()
-                in_group = True
+            try:
+                limits[key] = LIMIT_KEYS[key](value)
+            except ValueError:
+                errors.append((line_number, f"invalid value {value} for limit {key} in test {name}"))
+
+        # Do not allow duplicate test case names
+        duplicate = name in names
+        if duplicate:
+            errors.append((line_number, f"duplicate test name {name}"))
+        names.add(name)
+
+        # Process the goal string (second entry), replacing the test variables by their names
+        goal = Goal(TVAR_PATTERN.sub(r"\1", goal_str), TVAR_PATTERN.findall(goal_str))
+
+        # Expected values that the template of the test asks for
+        template_values = VALUE_PATTERN.findall(test_templates.get(type, ""))
+
+        # Process expected output:
+        # It is formatted as: <VAR1>=<RESULT1>|:|<VAR2>=<RESULT2>|:|<VAR3>=<RESULT3>|:|.... etc
+        expected = {}
+        for x in expected_str.split("|:|"):
+            if x.strip() == "":
                 continue
-            # Ending delimiter for optional groups
-            if test_line.startswith("--"):
-                test_group = ""
-                in_group = False
+            var, separator, value = x.strip().partition("=")
+            if not separator:
+                errors.append((line_number, f"expected value {x.strip()} in test {name} has no ="))
                 continue
 
-            # Split test case line on tabs, strip all remaining spaces, while ignoring empty strings resulting from that
-            split_test = [x.strip() for x in re.split(r"\t", test_line.strip()) if x.strip() != '']
-
-            # The first entry is the name, and the third entry is the type of test template to use
-            name = split_test[0].strip()
-            type = split_test[2].strip()
+            # Some more checks to make sure the expected results are sane in terms of variables used
+            if not var[:1].isupper():
+                errors.append((line_number, f"variable {var} in test {name} should start with uppercase character"))
+            # The "Result" variable is special and is used to output other meaningful data from certain queries,
+            # and the template of the test may ask for the expected values of other variables (see construct_test_query)
+            elif var not in goal.vars and var != "Result" and var not in template_values:
+                errors.append((line_number, f"variable {var} is not present in goal for test {name}"))
+            expected[var] = value
 
-            # If we're not in a test group, then the test group name trivially becomes the test's name
-            if not test_group:
-                test_group = name
+        for var in template_values:
+            if var not in expected:
+                errors.append((line_number, f"test {name} of type {type} needs an expected value for {var}"))
 
-            # Do not allow duplicate test case names
-            if name in map(lambda x: x.name, flatten(test_groups.values())):
-                print(col.FAIL, f"ERROR: Duplicate test names in {file_name}, please fix this!", col.ENDC)
-                exit(1)
+        # Put it in its optional group, if we're not in one the test group name trivially becomes the test's name
+        if not duplicate:
+            test_groups.setdefault(test_group or name, []).append(TestCase(name, type, goal, expected, limits))
 
-            # Will store a test goal and its test variables
-            Goal = namedtuple("Goal", ['goal', 'vars'])
+    return test_groups, errors
 
-            # Process the goal string (second entry), and deal with the test variables
-            goal_str = split_test[1].strip()
-            vars = re.findall(r"<TVAR:[A-Z]\w*>", goal_str)
-            var_list = []
-            # Extract test variable name, replace it in the goal and append it to the variable list
-            for var_raw in vars:
-                var = var_raw[var_raw.find(":") + 1:var_raw.find(">")]
-                goal_str = goal_str.replace(var_raw, var)
-                var_list.append(var)
-            goal = Goal(goal_str, var_list)
 
-            # Process expected output:
-            # It is formatted as: <VAR1>=<RESULT1>|:|<VAR2>=<RESULT2>|:|<VAR3>=<RESULT3>|:|.... etc
-            expected_list = [x.strip() for x in split_test[3].strip().split("|:|") if len(x.strip()) > 0]
-            expected = dict(map(lambda x: (x[:x.find("=")], x[x.find("=") + 1:]), expected_list))
+# Converts test groups to something that can be stored as JSON, and back
+def test_groups_to_json(test_groups):
+    return [[test_group, [[x.name, x.type, x.goal.goal, x.goal.vars, x.expected, x.limits]
+                          for x in test_groups[test_group]]]
+            for test_group in test_groups]
 
 
-            # Some more checks to make sure the expected results are sane in terms of variables used
-            for var in expected:
-                if not var[0].isupper():
-                    print(col.FAIL,
-                          f"Variable {var} in test {name} should start with uppercase character, aborting",
-                          col.ENDC)
-                    exit(1)
-                # The "Result" variable is special and is used to output other meaningful data from certain queries
-                if var not in var_list and var != "Result":
-                    print(col.FAIL, f"ERROR: variable {var} is not present in goal for test {name}, aborting",
-                          col.ENDC)
-                    exit(1)
-
-            # Construct test case instance
-            test_case = TestCase(name, type, goal, expected)
-
-            # Put it in a test group if the group already exists, otherwise put it in a new one
-            if test_group:
-                if test_group in test_groups:
-                    test_groups[test_group].append(test_case)
-                else:
-                    test_groups[test_group] = [test_case]
-
-        return test_groups
+def test_groups_from_json(data):
+    return {test_group: [TestCase(name, type, Goal(goal, vars), expected, limits)
+                         for name, type, goal, vars, expected, limits in cases]
+            for test_group, cases in data}
 
 
 # Initialize all the tests
@@ -249,7 +882,7 @@ def init_tests():
     # Iterate through the folders in "tests" folder
     for folder_name in map(os.path.basename, glob(f"{TESTS_PATH}{os.sep}*")):
         # Skip if folder starts with "_" or if it's not a folder at all
-        if folder_name.startswith("_") or not os.path.isdir(folder_name):
+        if folder_name.startswith("_") or not os.path.isdir(os.path.join(TESTS_PATH, folder_name)):
             continue
 
         test_path = f"{TESTS_PATH}{os.sep}{folder_name}{os.sep}"
@@ -257,7 +890,9 @@ def init_tests():
         # If it really contains a file with tests...
         if os.path.isfile(test_path + "tests.txt"):
             # Read the tests
-            test = Test(read_test_file(test_path + "tests.txt",))
+            test = Test(read_test_file(test_path + "tests.txt",),
+                        test_timeout=options.test_timeout, exercise_timeout=options.exercise_timeout,
+                        name=folder_name)
 
             # If present, read the file that contains the predicates to abolish (comma separated)
             if os.path.isfile(test_path + "abolish.txt"):
@@ -274,17 +909,105 @@ def init_tests():
                 with open(test_path + "database.pl", "r", errors='ignore') as file:
                     test.database = file.read()
 
+            # If present, read the file that overrides settings for this test (see CONFIG_KEYS)
+            if os.path.isfile(test_path + "config.txt"):
+                for key, value in read_config_file(test_path + "config.txt").items():
+                    setattr(test, key, value)
+
+            # The test cases are turned into prolog once, and the result is shared by all groups
+            compile_test(test)
+            write_compiled_test(folder_name, test)
+            test.fingerprint = test_fingerprint(test)
+            test.required = required_predicates(test)
+
             tests[folder_name] = test
 
 
-# Strip all types of comments to avoid some typos people make...
-# Also gets rid of some unsupported commenting format causing operator errors
-def remove_stupidity(text):
-    text = re.sub(re.compile('^%.*', re.MULTILINE), "", text)
-    text = re.sub(re.compile('^//.*', re.MULTILINE), "", text)
-    text = re.sub(re.compile('^/\*.*\*/', re.MULTILINE), "", text)
-    text = re.sub(re.compile('^/.*/', re.MULTILINE), "", text)
-    return text
+# The predicates called by the goal of every test case that a submission has to define itself, by test case name
+# Only test cases that need their goal to succeed have any (see GOAL_SUCCESS_TYPES), a test case that checks whether
+# a goal fails may well call a predicate that shouldn't be there
+# A test case whose goal calls a predicate that the test defines itself (in pre.pl, unless it is abolished, or in
+# database.pl) or that Prolog provides has none, and neither does one whose goal isn't made of plain calls
+# Only known when running on swipl workers, otherwise there are none
+def required_predicates(test):
+    if prolog_pool is None:
+        return {}
+    calls = {test_case.name: goal_predicates(test_case.goal.goal)
+             for test_case in flatten(test.test_groups.values()) if test_case.type in GOAL_SUCCESS_TYPES}
+    candidates = sorted(set(flatten(calls.values())))
+    pre = screen_source(test.pre)
+    database = screen_source(test.database, candidates)
+    available = set(database.predicates + database.provided) | (set(pre.predicates) - set(test.abolish))
+    return {name: predicates for name, predicates in calls.items() if predicates and available.isdisjoint(predicates)}
+
+
+# The predicates ("name/arity") called at the top level of a goal, the goals of a conjunction are split up
+# Anything that isn't a plain call, like X = Y or \+ p(X), is left out
+def goal_predicates(goal):
+    predicates = []
+    for part in split_arguments(goal) or []:
+        match = CALL_PATTERN.fullmatch(part.strip())
+        if match is None:
+            continue
+        arguments = [] if match.group(2) is None else split_arguments(match.group(2))
+        # The arguments have to be balanced, otherwise the call ended before the last closing bracket
+        if arguments is None or "" in [x.strip() for x in arguments]:
+            continue
+        predicates.append(f"{match.group(1)}/{len(arguments)}")
+    return predicates
+
+
+# Splits prolog text on the commas outside of brackets and quotes, returns None if the brackets are unbalanced
+def split_arguments(text):
+    parts = [""]
+    depth = 0
+    quote = None
+    escaped = False
+    for char in text:
+        if quote is not None:
+            if escaped:
+                escaped = False
+            elif char == "\\":
+                escaped = True
+            elif char == quote:
+                quote = None
+        elif char in "'\"`":
+            quote = char
+        elif char in "([{":
+            depth += 1
+        elif char in ")]}":
+            depth -= 1
+            if depth < 0:
+                return None
+        elif char == "," and depth == 0:
+            parts.append("")
+            continue
+        parts[-1] += char
+    if depth != 0 or quote is not None:
+        return None
+    return parts
+
+
+# Read a config file containing "key = value" lines, returns a dictionary with the converted values
+def read_config_file(file_name):
+    config = {}
+    with open(file_name, "r", errors='ignore') as file:
+        for test_line in file.readlines():
+            # Comments are ignored
+            if test_line.startswith("#") or test_line.strip() == "":
+                continue
+
+            key, _, value = [x.strip() for x in test_line.partition("=")]
+            if key not in CONFIG_KEYS:
+                print(col.FAIL, f"ERROR: Unknown setting {key} in {file_name}, aborting", col.ENDC)
+                exit(1)
+            try:
+                config[key] = CONFIG_KEYS[key](value)
+            except ValueError:
+                print(col.FAIL, f"ERROR: Invalid value {value} for setting {key} in {file_name}, aborting", col.ENDC)
+                exit(1)
+    return config
+
 
 
 # Extracts group name from blackboard style group names
@@ -301,81 +1024,93 @@ def get_group_name_brightspace(assignment_directory_name):
         return f"{splt[2].strip()}_{splt[3].strip()}"
     return "INVALID_FOLDER_NAME"
 
-# Unzips a zip file to the same folder it is in, then deletes it if possible
-def unzip(zip_path):
-    zip_ref = zipfile.ZipFile(zip_path, 'r')
-    zip_dir, _ = os.path.split(zip_path)
-    zip_ref.extractall(zip_dir)
-    zip_ref.close()
-    try:
-        os.remove(zip_path)
-    except:
-        print(col.FAIL, "ERROR: Could not remove zip file!", col.ENDC)
-        exit(1)
-
-
-# Recursively traverses the directory structure to find where the prolog files are located
-# It also unzips any .zip files it finds, and removes it when unzipped
-def get_prolog_files(directory_path):
-    files = []
-
-    for path in glob(directory_path + "\\*"):
-        if os.path.splitext(path)[-1] in [".zip"]:
-            unzip(path)
-            files += get_prolog_files(directory_path)
-        if os.path.splitext(path)[-1] in [".pl", ".pro"]:
-            files.append(path)
-        if os.path.isdir(path):
-            files += get_prolog_files(path)
-    return files
 
-
-# Load all assignment prolog files from all groups
-def init_assignments():
-    global assignments
-
-    # Get all submission folder paths
-    assignment_directories = glob(f"{ASSIGNMENTS_PATH}{os.sep}*")
-    Assignment = namedtuple("Assignment", ["assignment_path", "knowledge"])
-
-    # Iterate over them..
-    for assignment_path in assignment_directories:
-        # Ignore if not a directory
+# Reads the prolog files in a zip archive without extracting it, zip archives inside it are read as well
+# Yields the path and contents of every prolog file
+def read_zip_sources(zip_file, zip_path):
+    for member in sorted(zip_file.namelist()):
+        if any(is_hidden(part) for part in member.split("/")):
+            continue
+        member_path = os.path.join(zip_path, member)
+        if os.path.splitext(member)[-1] == ".zip":
+            try:
+                with zipfile.ZipFile(io.BytesIO(zip_file.read(member))) as inner_zip_file:
+                    yield from read_zip_sources(inner_zip_file, member_path)
+            except zipfile.BadZipFile:
+                log(col.WARNING, f"Could not read zip file {member_path}, skipping it...", col.ENDC)
+        elif os.path.splitext(member)[-1] in PROLOG_EXTENSIONS:
+            yield member_path, zip_file.read(member).decode("utf-8", errors='ignore')
+
+
+# Traverses the directory structure once to find the prolog files, and reads them
+# Zip files are read in memory, the directory is left untouched
+# Yields the path and contents of every prolog file
+def read_prolog_sources(directory_path):
+    for root, directories, files in os.walk(directory_path):
+        directories[:] = sorted(directory for directory in directories if not is_hidden(directory))
+        for file_name in sorted(file_name for file_name in files if not is_hidden(file_name)):
+            path = os.path.join(root, file_name)
+            if os.path.splitext(path)[-1] == ".zip":
+                try:
+                    with zipfile.ZipFile(path) as zip_file:
+                        yield from read_zip_sources(zip_file, path)
+                except zipfile.BadZipFile:
+                    log(col.WARNING, f"Could not read zip file {path}, skipping it...", col.ENDC)
+            elif os.path.splitext(path)[-1] in PROLOG_EXTENSIONS:
+                with open(path, "r", errors='ignore') as file:
+                    yield path, file.read()
+
+
+# Whether a file or folder in a submission should be left out, like the hidden files and the __MACOSX folder that
+# come with zip files made on a Mac (its ._*.pl files are not prolog at all)
+def is_hidden(name):
+    return name.startswith(".") or name == "__MACOSX"
+
+
+# Reads the knowledge of a single group, concatenated from all prolog files found in its submission folder
+# Returns the knowledge and its LineMap, the knowledge is an empty string if there's nothing to test
+def read_knowledge(assignment_path):
+    return join_sources(read_prolog_sources(assignment_path))
+
+
+# Concatenates the prolog sources of a submission into its knowledge, without their comments (see normalize_source)
+# Returns the knowledge and a LineMap that tells which file every line of it came from
+def join_sources(sources):
+    parts = []
+    line_map = LineMap()
+    for path, source in sources:
+        source = normalize_source(source)
+        line_map.add(path, source)
+        parts.append(source + "\n")
+    return "".join(parts), line_map
+
+
+# Finds the submissions of all groups, and yields the name of every group in folder order
+# Only the folder of every group is kept in assignments, its knowledge is read when it is graded (see grade_group)
+def read_assignments():
+    # Get all submission folder paths, ignoring anything that is not a directory
+    for assignment_path in sorted(glob(f"{ASSIGNMENTS_PATH}{os.sep}*")):
         if not os.path.isdir(assignment_path):
             continue
-
-        # Get the group name
         group_name = get_group_name_brightspace(assignment_path)
-
-        # Create knowledge file, concatenated from all prolog files found in the submission folder
-        knowledge = ""
-        for file_path in get_prolog_files(assignment_path):
-            with open(file_path, "r", errors='ignore') as file:
-                knowledge += file.read() + "\n"
-
-        # If no knowledge was added, skip the group, since there's nothing to test
-        if knowledge == "":
-            print(col.WARNING, f"Group {group_name} has no prolog files that can be tested...", col.ENDC)
+        if group_name in assignments:
+            print(col.WARNING, f"Group {group_name} has more than one submission folder, only grading "
+                               f"{assignments[group_name].assignment_path}...", col.ENDC)
             continue
-
-        assignments[group_name] = Assignment(assignment_path, remove_stupidity(knowledge))
-
-
-# Construct an appropriate command string from a list of commands
-def to_cmd_string(cmd_list):
-    cmd = ""
-    for s in cmd_list:
-        cmd += s + " & "
-    return cmd[:-3]
+        assignments[group_name] = Assignment(assignment_path)
+        yield group_name
 
 
-# Call a command given shell and obtain output and errors. Kill process after that.
-# TODO: Could vastly speed things up if prolog would be kept alive instead
-def command_call(shell, command):
-    shell = shell[:] + [to_cmd_string(command)]
-    p = Popen(shell, stdout=PIPE, stderr=PIPE, shell=True)
-    output, error = p.communicate()
-    p.kill()
+# Run a command (a list of the program and its arguments, no shell involved) and obtain output and errors
+# If it takes longer than timeout seconds, the process is killed and a time limit error is reported instead
+def command_call(command, cwd=None, timeout=None):
+    p = Popen(command, stdout=PIPE, stderr=PIPE, cwd=cwd)
+    try:
+        output, error = p.communicate(timeout=timeout)
+    except TimeoutExpired:
+        p.kill()
+        p.communicate()
+        return "", TIME_LIMIT_ERROR
     # Ignore decoding errors to prevent any stalls
     return output.decode("utf-8", errors='ignore'), error.decode("utf-8", errors='ignore')
 
@@ -389,182 +1124,463 @@ def flatten(l):
 # <GOAL> will be replace by the test goal
 # <EXPECTED> will be replaced by the expected values for the variables
 # <WRITEVAR> will be replaced by some code that will output the value of the variable, separated by delimiters
+# <SOLUTION> will be replaced by the test variable, or a list of them if there are several, for templates that
+# collect all solutions of the goal
+# <VALUE:Var> will be replaced by the expected value of Var
+# Whatever the template writes is written through checker_write/1 and checker_writeln/1, and every |:| it writes
+# through checker_separator/0, see TEST_SOURCE_HEADER
 def construct_test_query(test_case):
-    template = test_templates[test_case.type]
+    template = SEPARATOR_PATTERN.sub("checker_separator", test_templates[test_case.type])
+    template = WRITE_PATTERN.sub(r"checker_\1(", template)
 
     # Construct goal
     template = template.replace("<GOAL>", test_case.goal.goal)
 
+    # Construct the solution term and expected values
+    solution = test_case.goal.vars[0] if len(test_case.goal.vars) == 1 else f"[{','.join(test_case.goal.vars)}]"
+    template = template.replace("<SOLUTION>", solution)
+    template = VALUE_PATTERN.sub(lambda match: test_case.expected[match.group(1)], template)
+
     # Construct unification test(s)
     uni = []
     write = [test_case.goal.goal]
     for var in test_case.expected:
         uni.append(f"{var}={test_case.expected[var]}")
-        write.append(f'write("{var}"),write("="),write({var}),write("|:|")')
+        write.append(f'checker_write("{var}"),checker_write("="),checker_write({var}),checker_separator')
     template = template.replace("<EXPECTED>", ",".join(uni))
     template = template.replace("<WRITEVAR>", ",".join(write))
     return template
 
 
-# Creates a test file that prolog can run, consisting of a single test
-def make_single_test_file(test_case):
-    if test_case.type not in test_templates:
-        return False
-    with open(test_case.type + ".temp", "w") as out_file:
-        out_file.write("go :- " + construct_test_query(test_case) + ".")
-    return True
+# The limits of a test case: those of its test, overridden by its own
+def test_limits(test, test_case):
+    limits = {key: getattr(test, key) for key in LIMIT_KEYS}
+    limits.update(test_case.limits)
+    return limits
+
+
+# Wraps a test query so that it reports a timeout after the time limit, instead of running forever,
+# and that it reports running out of inferences, stack or table space as "resource" (see checker_limit/2)
+def limit_test_query(query, limits):
+    if limits["test_timeout"]:
+        query = f"catch(call_with_time_limit({limits['test_timeout']}, ({query})), time_limit_exceeded, " \
+                f'(checker_write("Time limit exceeded"),checker_separator,checker_writeln(timeout)))'
+
+    prolog_limits = []
+    if limits["inference_limit"]:
+        prolog_limits.append(f"inference_limit({limits['inference_limit']})")
+    for flag in ["stack_limit", "table_space"]:
+        if limits[flag]:
+            prolog_limits.append(f"{flag}-{limits[flag]}")
+    return f"checker_limit(({query}), [{','.join(prolog_limits)}])"
+
+
+# Compiles the test cases of a test into a prolog source, with a predicate for every test case
+# Every test case predicate reports what it wrote under its own name, see TEST_SOURCE_HEADER
+# The test cases of the test are replaced by ones that know their predicate, test cases of an unknown type get none
+def compile_test(test):
+    clauses = []
+    index = 0
+    test_groups = {}
+    for test_group in test.test_groups:
+        test_groups[test_group] = []
+        for test_case in test.test_groups[test_group]:
+            if test_case.type in test_templates:
+                test_case = test_case._replace(predicate=f"test_case_{index}")
+                pl_code = limit_test_query(construct_test_query(test_case), test_limits(test, test_case))
+                clauses.append(f"% {test_case.name}\n"
+                               f"{test_case.predicate} :- checker_run({test_case.predicate}, {pl_code}).\n")
+            test_groups[test_group].append(test_case)
+            index += 1
+
+    test.test_groups = test_groups
+    test.source = TEST_SOURCE_HEADER + "\n".join(clauses)
 
 
-# Creates a test file that prolog can run, consisting of all test cases in a test, magically fused together
-def make_composed_test_file(test_cases):
-    test_str = "go :- "
+# Hashes everything that determines the outcome of a test, and the layout of its out files
+def test_fingerprint(test):
+    layout = [(test_group, [test_case.name for test_case in test.test_groups[test_group]])
+              for test_group in test.test_groups]
+    return make_key("test", test.source, test.pre, test.abolish, test.database, test.exercise_timeout, layout)
+
+
+# Writes the compiled test to the compiled tests folder, so that a run can be reproduced by hand
+def write_compiled_test(exercise, test):
+    os.makedirs(COMPILED_TESTS_PATH, exist_ok=True)
+    with open(os.path.join(COMPILED_TESTS_PATH, f"{exercise}.pl"), "w") as file:
+        file.write(test.source)
+
+
+# Creates the goal that runs the given test cases one after the other, returns None if that is impossible
+def make_test_goal(test_cases):
     for test_case in test_cases:
-        if test_case.type not in test_templates:
-            print(col.FAIL, f"Test file creation failed, unknown test_case type {test_case.type}", col.ENDC)
-            return False
-        pl_code = construct_test_query(test_case)
-        pl_code = pl_code.replace("writeln(pass)", "write(pass),writeln('||||')")
-        pl_code = pl_code.replace("writeln(fail)", "write(fail),writeln('||||')")
-
-        # This regex is very magical, it basically captures prolog variables without stuff that is not a prolog variable
-        # It's necessary to do this replacement, to allow unique variable names between the test cases
-        pl_code = re.sub(r'\b([A-Z](\w)*)\b(?=(?:[^\"]|\"[^\"]*\")*$)(?=(?:[^\']|\'[^\']*\')*$)',
-                         r'\1' + "_" + test_case.name.upper(), pl_code)
-        test_str += "(" + pl_code + "),"
-
-    with open("composed.temp", "w") as out_file:
-        out_file.write(test_str[:-1] + ".")
-    return True
+        if test_case.predicate is None:
+            log(col.FAIL, f"Test file creation failed, unknown test_case type {test_case.type}", col.ENDC)
+            return None
+    return ",".join(test_case.predicate for test_case in test_cases)
+
 
+# Constructs the job that runs a goal from the compiled test against the knowledge of a group
+# The job may take the time that is left until the deadline of the exercise (see exercise_deadline)
+def make_test_job(test, knowledge, test_goal, deadline=None):
+    # 128k of stack to make it crash early on infinite loops, the time limit catches the loops that don't need stack
+    time_limit = test.exercise_timeout if deadline is None else deadline - time.monotonic()
+    return PrologJob(knowledge=knowledge, pre=test.pre, abolish=test.abolish, database=test.database,
+                     test=test.source, goal=test_goal, stack_limit="128k", time_limit=time_limit,
+                     profile=options.profile)
 
-# Constructs the goal to use in the commandline for swi-prolog
-def construct_test_goal(test_type, abolish_list, pre_processing, database):
+
+# The moment (in time.monotonic() seconds) all runs of an exercise have to be done by, None if there is no limit
+def exercise_deadline(test):
+    if not test.exercise_timeout:
+        return None
+    return time.monotonic() + test.exercise_timeout
+
+
+# Whether the deadline of an exercise has passed
+def past_deadline(deadline):
+    return deadline is not None and time.monotonic() >= deadline
+
+
+# Constructs the goal to use in the commandline for swi-prolog, the job's sources are written to temporary files
+# in the directory swipl is started in
+def construct_test_goal(job):
     goal = ""
 
-    if pre_processing:
+    if job.pre:
         goal += 'consult("pre.temp"),'
     goal += 'consult("knowledge.temp"),'
-    if abolish_list:
-        for predicate in abolish_list:
+    if job.abolish:
+        for predicate in job.abolish:
             goal += f"abolish({predicate}),"
-    if database:
+    if job.database:
         goal += 'consult("database.temp"),'
-    goal += f'consult("{test_type}.temp"),'
-    goal += "go."
-    return goal
+    if job.test:
+        goal += 'consult("report.temp"),consult("test.temp"),'
+    if job.goal:
+        goal += job.goal + ","
+    goal = goal[:-1]
+    if job.time_limit:
+        goal = f"call_with_time_limit({job.time_limit},({goal}))"
+    return goal + "."
+
+
+# Runs a job in a fresh swipl process, returns a PrologResult
+# The steps of the job can't be profiled this way, so its profile is always empty
+def run_prolog_once(job):
+    # Every run gets its own scratch directory, so that runs can happen in parallel
+    with tempfile.TemporaryDirectory(prefix="prolog_job_") as scratch_dir:
+        # Write the sources to the scratch directory so that we may use them in the commandline call
+        for name, source in [("pre", job.pre), ("knowledge", job.knowledge), ("database", job.database),
+                             ("test", job.test), ("report", REPORT_SOURCE)]:
+            with open(os.path.join(scratch_dir, f"{name}.temp"), "w") as file:
+                file.write(source)
+
+        # -G: set global stack size, small to make it crash early on infinite loops
+        # -q: set mode on quiet, no meaningless output
+        # -g: Run goal after this token
+        # -t: Run what comes after this token at the end (in this case, halt)
+        # The goal is passed as a single argument, so it needs no quoting
+        cmd = [swipl_command, f"-G{job.stack_limit}", "-q", "-g", construct_test_goal(job), "-t", "halt"]
+        output, error = command_call(cmd, cwd=scratch_dir, timeout=kill_timeout(job))
+
+        # The test cases report to their own file, see REPORT_SOURCE
+        results = []
+        results_path = os.path.join(scratch_dir, "results.temp")
+        if os.path.isfile(results_path):
+            with open(results_path, "r", encoding="utf-8", errors='ignore') as file:
+                results = [json.loads(line) for line in file if line.strip()]
+        return PrologResult(output, error, [], results)
+
+
+# Runs a job on the worker reserved by the current thread, otherwise through the worker pool if there is one,
+# otherwise in a fresh swipl process
+# Returns a PrologResult, its profile is recorded for the current group and the given test
+def run_prolog(job, test=None):
+    start = time.monotonic()
+    worker = getattr(group_worker, "worker", None)
+    if worker is not None:
+        out = worker.run(job)
+    elif prolog_pool is not None:
+        out = prolog_pool.run(job)
+    else:
+        out = run_prolog_once(job)
+
+    if profiler is not None:
+        record_profile(test, time.monotonic() - start, out.profile)
+    return out
+
+
+# Adds the profile of a run to the profiler, the steps that ran a test case are marked with the name of the test case
+def record_profile(test, total, steps):
+    exercise = None
+    if test is not None:
+        exercise = test.name
+        names = {f"call {test_case.predicate}": test_case.name for test_case in flatten(test.test_groups.values())}
+        steps = [dict(step, test=names[step["step"]]) if step["step"] in names else step for step in steps]
+    profiler.add_run(getattr(current_group, "name", None), exercise, total, steps)
+
+
+# What every test case of a run reported (its output and the seconds it took), keyed on the predicate of the test case
+def test_results(out):
+    return {result["id"]: result for result in out.results}
+
+
+# Turns the strings a test case wrote into its result and whether it passed
+# The results for the test variables are always separated by a separator (None), the final one tells whether the test
+# passed or failed, so a value that contains |:|, or even is |:|, is never mistaken for a separator
+# The duration is the one the test case reported itself, or else the given one
+def read_test_output(reported, duration=None):
+    tokens = [""]
+    for written in reported["output"]:
+        if written is None:
+            tokens.append("")
+        else:
+            tokens[-1] += written
+    return TestResult(tokens[-1].strip(), [x.strip() for x in tokens[:-1]], reported.get("duration", duration))
 
 
 # TODO: Factor out the common parts between the two test running methods
 
-# Run a single test, returns True if test succeeds, False otherwise
-def run_test(test, test_case):
-    if not make_single_test_file(test_case):
-        print(col.FAIL, f"  Test file creation failed for test {test_case.name}, check tests file", col.ENDC)
-        test_case.result = "ERROR, test file creation failed, check tests file"
+# Run a single test, its outcome is stored in results, returns True if test succeeds, False otherwise
+def run_test(test, test_case, knowledge, results, deadline=None):
+    if test_case.predicate is None:
+        log(col.FAIL, f"  Test file creation failed for test {test_case.name}, check tests file", col.ENDC)
+        results[test_case.name] = TestResult("unknown", ["ERROR, test file creation failed, check tests file"])
         return False
 
-    # Construct goal
-    goal = construct_test_goal(test_case.type, test.abolish, test.pre, test.database)
-    # -G128k: set global stack to 128kb to make it crash early on infinite loops
-    # -q: set mode on quiet, no meaningless output
-    # -g: Run goal after this token
-    # -t: Run what comes after this token at the end (in this case, halt)
-    cmd = ['swipl -G128k -q -g' + " " + goal + f" -t halt"]
-    out = command_call(shell_command, cmd)
+    start = time.monotonic()
+    out = run_prolog(make_test_job(test, knowledge, test_case.predicate, deadline), test)
+    duration = time.monotonic() - start
 
     # If there's an error, put that in the result field instead
-    if out[1].count("ERROR:") > 0:
-        print(f"  Test {test_case.name} produced an error in SWI-Prolog:")
+    if out.err.count("ERROR:") > 0:
+        log(f"  Test {test_case.name} produced an error in SWI-Prolog:")
         error_message = ""
-        for line in out[1].split("\n"):
+        for line in out.err.split("\n"):
             if "ERROR" in line:
                 error_message += line.strip() + " "
-                print(col.FAIL + "  \t" + line + col.ENDC)
-        test_case.result = [f"Prolog error report: {error_message}"]
-        test_case.success = "fail"
+                log(col.FAIL + "  \t" + line + col.ENDC)
+        # Running out of time is reported as such, so it can be told apart from wrong answers, and so is a worker that
+        # failed, which says nothing about the test case (neither of them is cached)
+        if "Time limit exceeded" in error_message:
+            success = "timeout"
+        elif WORKER_ERROR in out.err:
+            success = "error"
+        else:
+            success = "fail"
+        results[test_case.name] = TestResult(success, [f"Prolog error report: {error_message}"], duration)
         return False
 
-    # The results for the test variables are always separated by |:|
-    output = out[0].strip().split("|:|")
-    test_case.result = [x.strip() for x in output[:-1]]
-
-    # Final token tells whether the test passed or failed
-    test_case.success = output[-1].strip()
+    # A test case that didn't get to report anything failed without saying why
+    reported = test_results(out)
+    if test_case.predicate not in reported:
+        results[test_case.name] = TestResult("fail", ["No result was reported"], duration)
+        return True
 
+    results[test_case.name] = read_test_output(reported[test_case.predicate], duration)
     return True
 
 
-# Run a composed test, returns True if test succeeds, False otherwise
-def run_composed_test(test):
-    test_cases = flatten(test.test_groups.values())
-    if not make_composed_test_file(test_cases):
-        return False
+# Run a composed test of the given test cases (all of them by default)
+# The outcomes of the test cases that reported theirs are stored in results, also if the run failed halfway
+# Returns the test cases that didn't report their outcome, none if the run succeeded
+def run_composed_test(test, knowledge, results, test_cases=None, deadline=None):
+    if test_cases is None:
+        test_cases = flatten(test.test_groups.values())
+    test_goal = make_test_goal(test_cases)
+    if test_goal is None:
+        return test_cases
 
-    # Construct goal
-    goal = construct_test_goal("composed", test.abolish, test.pre, test.database)
-    # -G128k: set global stack to 128kb to make it crash early on infinite loops
-    # -q: set mode on quiet, no meaningless output
-    # -g: Run goal after this token
-    # -t: Run what comes after this token at the end (in this case, halt)
-    cmd = ['swipl -G128k -q -g' + " " + goal + f" -t halt"]
-    out = command_call(shell_command, cmd)
-    results = out[0].split("||||")[
-              :-1]  # This sequence is always present at the end, so last split entry always empty
-
-    # If there's an error, print it and return False
-    if out[1].count("ERROR:") > 0:
-        print(f"Composed test produced an error in SWI-Prolog:")
-        for line in out[1].split("\n"):
-            if "ERROR" in line:
-                print(col.FAIL + "\t" + line + col.ENDC)
-        return False
+    out = run_prolog(make_test_job(test, knowledge, test_goal, deadline), test)
+    reported = test_results(out)
 
-    # In some odd cases, there may be a number of results different from the number of test cases
-    # In such a case the test should fail, as its output is meaningless and crash-prone
-    if len(test_cases) != len(results):
-        return False
+    # If there's an error, print it, the test cases that didn't get to report have to run again
+    if out.err.count("ERROR:") > 0:
+        log(f"Composed test produced an error in SWI-Prolog:")
+        for line in out.err.split("\n"):
+            if "ERROR" in line:
+                log(col.FAIL + "\t" + line + col.ENDC)
 
-    # Process the results for each test case
-    count = 0
-    for result in results:
-        # The results for the test variables are always separated by |:|
-        output = result.strip().split("|:|")
-        test_cases[count].result = [x.strip() for x in output[:-1]]
+    # Process the results for each test case that reported, each with the time it took itself
+    # A test case that didn't report its result was still running, or never started, when the run ended
+    remaining = []
+    for test_case in test_cases:
+        if test_case.predicate in reported:
+            results[test_case.name] = read_test_output(reported[test_case.predicate])
+        else:
+            remaining.append(test_case)
+    return remaining
+
+
+# Runs the given test cases as a composed test, if that fails each half of the test cases that didn't report their
+# outcome is run the same way
+# A single test case is run on its own, so that its error ends up in its result
+# Once the deadline of the exercise has passed, the test cases that are left are not run, but time out
+def run_bisected_test(exercise, test, knowledge, test_cases, results, deadline=None):
+    if not test_cases:
+        return
+    if past_deadline(deadline):
+        log(f"  Time limit of exercise {exercise} exceeded, {len(test_cases)} test(s) were not run")
+        for test_case in test_cases:
+            results[test_case.name] = TestResult("timeout", ["Exercise time limit exceeded"])
+        return
+    if len(test_cases) == 1:
+        if run_test(test, test_cases[0], knowledge, results, deadline):
+            log(f"  Test {test_cases[0].name} for exercise {exercise} executed successfully!")
+        else:
+            log(f"  Test {test_cases[0].name} for exercise {exercise} failed!")
+        return
+
+    remaining = run_composed_test(test, knowledge, results, test_cases, deadline)
+    if not remaining:
+        log(f"  Tests {test_cases[0].name} to {test_cases[-1].name} for exercise {exercise} executed successfully!")
+        return
+
+    middle = len(remaining) // 2
+    run_bisected_test(exercise, test, knowledge, remaining[:middle], results, deadline)
+    run_bisected_test(exercise, test, knowledge, remaining[middle:], results, deadline)
+
+
+# The cache key of a test case, built from everything that can influence its result
+def test_case_key(test, test_case, knowledge):
+    return make_key("test", knowledge, test.pre, test.abolish, test.database, test_limits(test, test_case),
+                    test_templates.get(test_case.type), test_case.type, test_case.goal.goal, test_case.goal.vars,
+                    test_case.expected)
+
+
+# Fills in the results of test cases that were run before, returns the test cases that still need to run
+def restore_cached_results(test, test_cases, knowledge, results):
+    if result_cache is None:
+        return test_cases
+
+    uncached = []
+    for test_case in test_cases:
+        cached = result_cache.get(test_case_key(test, test_case, knowledge))
+        if cached is None:
+            uncached.append(test_case)
+        else:
+            results[test_case.name] = TestResult(cached["success"], cached["result"], cached.get("duration"))
+    return uncached
 
-        # Final token tells whether the test passed or failed
-        test_cases[count].success = output[-1].strip()
-        count += 1
 
-    return True
+# Stores the results of test cases that were just run in the cache
+def cache_results(test, test_cases, knowledge, results):
+    if result_cache is None:
+        return
 
+    for test_case in test_cases:
+        result = results.get(test_case.name, NOT_RUN)
+        if result.success in CACHEABLE_RESULTS:
+            result_cache.put(test_case_key(test, test_case, knowledge),
+                             {"result": result.result, "success": result.success, "duration": result.duration})
 
-# Runs a test, and creates the output files
-def process_hand_in(group_name, exercise, test):
 
-    # Run tests
-    # If the composed test fails its run...
-    if not run_composed_test(test):
-        print(f"Composed test for exercise {exercise} failed for group {group_name}, running single tests instead...")
+# Writes a record of every test case result of an exercise to the results file
+def record_results(group_name, exercise, test, run_test_cases, results):
+    if results_store is None:
+        return
 
-        # Run the test groups individually (single tests have their own group)
-        for test_group in test.test_groups:
-            for test_case in test.test_groups[test_group]:
-                if run_test(test, test_case):
-                    print(f"  Test {test_case.name} for exercise {exercise} executed successfully!")
-                else:
-                    print(f"  Test {test_case.name} for exercise {exercise} failed!")
+    run_names = {test_case.name for test_case in run_test_cases}
+    for test_group in test.test_groups:
+        for test_case in test.test_groups[test_group]:
+            result = results.get(test_case.name, NOT_RUN)
+            results_store.add({
+                "run": run_id,
+                "group": group_name,
+                "exercise": exercise,
+                "test_group": test_group,
+                "name": test_case.name,
+                "type": test_case.type,
+                "success": result.success,
+                "result": result.result,
+                "duration": result.duration,
+                "cached": test_case.name not in run_names,
+            })
+
+
+# Runs a test, and creates the output files, returns the outcome of every test case (see run_hand_in)
+def process_hand_in(group_name, exercise, test, knowledge, defined=None):
+    results = run_hand_in(group_name, exercise, test, knowledge, defined)
+    write_out_file(group_name, exercise, test, results)
+    return results
+
+
+# Runs a test, returns the outcome of every test case (keys: test case names, values: a TestResult)
+# defined is the set of predicates the knowledge defines, if known
+def run_hand_in(group_name, exercise, test, knowledge, defined=None):
+    results = {}
+    start = time.monotonic()
+
+    # A test case that needs its goal to succeed can't pass if the knowledge defines none of the predicates its goal
+    # calls (see required_predicates), the other test cases still run
+    test_cases = flatten(test.test_groups.values())
+    undefined = []
+    if defined is not None:
+        undefined = [test_case for test_case in test_cases
+                     if test.required.get(test_case.name) and defined.isdisjoint(test.required[test_case.name])]
+    if undefined:
+        missing = sorted(set(flatten(test.required[test_case.name] for test_case in undefined)))
+        log(f"Group {group_name} defines none of {', '.join(missing)}, "
+            f"skipping {len(undefined)} test(s) for exercise {exercise}")
+        for test_case in undefined:
+            results[test_case.name] = TestResult("fail", [f"Not defined: {', '.join(test.required[test_case.name])}"])
+        skipped = {test_case.name for test_case in undefined}
+        test_cases = [test_case for test_case in test_cases if test_case.name not in skipped]
+
+    # Only the test cases that weren't run before on the same knowledge need to be run
+    run_test_cases = restore_cached_results(test, test_cases, knowledge, results)
+
+    # Run tests, all runs together may take as long as the exercise timeout
+    deadline = exercise_deadline(test)
+    fallback = False
+    if not run_test_cases:
+        if test_cases:
+            log(f"All results for exercise {exercise} were taken from the cache for group {group_name}")
     else:
-        print(f"Composed test for exercise {exercise} executed successfully for group {group_name}")
-
-    # Determine whether all test_cases succeeded or not
+        remaining = run_composed_test(test, knowledge, results, run_test_cases, deadline)
+        # If the composed test fails its run...
+        if remaining:
+            log(f"Composed test for exercise {exercise} failed for group {group_name}, "
+                f"narrowing down the failing tests...")
+            fallback = True
+
+            # Split the tests that didn't report in halves, and keep splitting the halves that fail, until only
+            # single tests remain
+            middle = len(remaining) // 2
+            run_bisected_test(exercise, test, knowledge, remaining[:middle], results, deadline)
+            run_bisected_test(exercise, test, knowledge, remaining[middle:], results, deadline)
+        else:
+            log(f"Composed test for exercise {exercise} executed successfully for group {group_name}")
+
+    # How long the tests took is remembered for scheduling the next run, unless nothing had to run
+    if run_test_cases and run_times is not None:
+        run_times.set(group_name, exercise, time.monotonic() - start, fallback)
+
+    cache_results(test, run_test_cases, knowledge, results)
+    record_results(group_name, exercise, test, undefined + run_test_cases, results)
+    return results
+
+
+# Scores a test that was run, returns "+" if every test group passed and "-" otherwise,
+# and the number of passed test cases of every test group
+# An optional group passes if any of its test cases does
+def score_test(test, results):
     correct = "+"
     scores = {}
     for test_group in test.test_groups:
         test_cases_group = test.test_groups[test_group]
-        score = sum([1 for x in test_cases_group if x.success == "pass"])
+        score = sum([1 for x in test_cases_group if results.get(x.name, NOT_RUN).success == "pass"])
         if score == 0:
             correct = "-"
         scores[test_group] = score
+    return correct, scores
+
+
+# Writes the out file of a test that was run to the group's assignment folder
+def write_out_file(group_name, exercise, test, results):
+    # Determine whether all test_cases succeeded or not
+    correct, scores = score_test(test, results)
 
     # Write output file
     # TODO: Split this off so that the table can be constructed for columns of arbitrary size
@@ -585,16 +1601,103 @@ def process_hand_in(group_name, exercise, test):
                 file.write(f"{'OPTIONAL GROUP: ' + test_group:<115}{a(scores[test_group])}\n")
                 file.write("-"*250+"\n")
             for test_case in test_cases_group:
+                result = results.get(test_case.name, NOT_RUN)
                 file.write(
                     f"{spaces + test_case.name:<40}"
                     f"{test_case.goal.goal:<60}"
                     f"{test_case.type:<15}"
-                    f"{test_case.success:<15}"
+                    f"{result.success:<15}"
                     f"{','.join(map(lambda x: x+'='+test_case.expected[x], test_case.expected)):<80}"
-                    f"{', '.join(test_case.result):<80}" + "\n"
+                    f"{', '.join(result.result):<80}" + "\n"
                 )
             if len(test_cases_group) > 1:
                 file.write("\n")
 
+
+# Grades the submissions that are sent to the grading service, until it is stopped
+def serve():
+    server = GradingServer(SERVER_HOST, options.serve, grade_submission, options.jobs, SERVER_QUEUE_SIZE)
+    print(col.OKGREEN, f"Grading submissions sent to http://{SERVER_HOST}:{options.serve}/grade, "
+                       f"press Ctrl+C to stop", col.ENDC)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
+
+
+# Grades a submission sent to the grading service, returns the results of every exercise it was graded for
+# Nothing is written to the submission itself
+def grade_submission(submission):
+    exercises = submission.exercises or list(tests)
+    for exercise in exercises:
+        if exercise not in tests:
+            raise SubmissionError(f"unknown exercise {exercise}")
+    knowledge, line_map = read_submission(submission)
+
+    log_buffer.lines = []
+    current_group.name = submission.name
+    try:
+        log(f"Processing submission {submission.name}")
+        reports = {}
+        with knowledge_session(knowledge):
+            valid, defined = check_knowledge(knowledge, line_map)
+            if not valid:
+                log(col.WARNING, f"Knowledge of submission {submission.name} contains errors, skipping test run..",
+                    col.ENDC)
+            else:
+                for exercise in exercises:
+                    results = run_hand_in(submission.name, exercise, tests[exercise], knowledge, defined)
+                    reports[exercise] = test_report(tests[exercise], results)
+        return {"name": submission.name, "valid": valid, "exercises": reports, "log": log_buffer.lines}
+    finally:
+        log_buffer.lines = None
+        current_group.name = None
+
+
+# Reads the knowledge of a submission sent to the grading service
+def read_submission(submission):
+    if submission.data is not None:
+        try:
+            with zipfile.ZipFile(io.BytesIO(submission.data)) as zip_file:
+                knowledge, line_map = join_sources(read_zip_sources(zip_file, submission.name))
+        except zipfile.BadZipFile:
+            raise SubmissionError("the uploaded file is not a zip file")
+    elif os.path.isdir(submission.path):
+        knowledge, line_map = join_sources(read_prolog_sources(submission.path))
+    elif os.path.splitext(submission.path)[-1] == ".zip" and os.path.isfile(submission.path):
+        try:
+            with zipfile.ZipFile(submission.path) as zip_file:
+                knowledge, line_map = join_sources(read_zip_sources(zip_file, submission.path))
+        except zipfile.BadZipFile:
+            raise SubmissionError(f"{submission.path} is not a zip file")
+    else:
+        raise SubmissionError(f"{submission.path} is not a folder or zip file")
+
+    if knowledge == "":
+        raise SubmissionError("the submission has no prolog files that can be tested")
+    return knowledge, line_map
+
+
+# The results of a test that was run, as something JSON can represent
+def test_report(test, results):
+    correct, scores = score_test(test, results)
+    return {
+        "passed": correct == "+",
+        "test_groups": {test_group: {
+            "passed": scores[test_group] > 0,
+            "test_cases": [{
+                "name": test_case.name,
+                "goal": test_case.goal.goal,
+                "type": test_case.type,
+                "expected": test_case.expected,
+                **results.get(test_case.name, NOT_RUN)._asdict(),
+            } for test_case in test.test_groups[test_group]],
+        } for test_group in test.test_groups},
+    }
+
+
 # :D
-main()
+if __name__ == "__main__":
+    main()
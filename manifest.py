@@ -0,0 +1,8 @@
+from json_store import MergedJsonStore
+
+
+# Remembers a fingerprint of the inputs that every (group, exercise) pair was last graded with
+# When the file is shared by several processes, a lost save only means those exercises get graded again
+class Manifest(MergedJsonStore):
+    def set(self, group, exercise, fingerprint):
+        self.put(group, exercise, fingerprint)
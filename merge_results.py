@@ -0,0 +1,94 @@
+from print_colors import colors as col
+from results_store import read_results
+from glob import glob
+import argparse
+import csv
+import json
+import os
+
+# Merges the results files of several shards or queue workers (see --shard and --queue in main.py) into one,
+# and writes a report with a line for every group and exercise
+# Of every group and exercise, only the records of the latest run that graded it are kept
+# Runs are told apart by their id: the time they started in UTC followed by the process that ran them
+
+# PATH CONSTANTS
+SHARD_RESULTS_PATTERN = "results.*.jsonl"
+MERGED_RESULTS_PATH = "merged_results.jsonl"   # Not results.jsonl, which main.py appends to when run without workers
+REPORT_PATH = "report.csv"
+
+
+# Keeps the records of the latest run of every group and exercise, a test case that is in there twice
+# (because its group was graded twice in the same run) keeps its last record
+# Returns a dictionary with keys: (group, exercise), values: a list of records
+def merge_records(records):
+    latest = {}
+    for record in records:
+        key = (record["group"], record["exercise"])
+        run, test_cases = latest.get(key, ("", {}))
+        if record["run"] > run:
+            run, test_cases = record["run"], {}
+        elif record["run"] < run:
+            continue
+        test_cases[(record["test_group"], record["name"])] = record
+        latest[key] = (run, test_cases)
+    return {key: list(test_cases.values()) for key, (run, test_cases) in latest.items()}
+
+
+# A line of the report for the records of a group and exercise
+# The exercise is passed ("+") if every test group has a passing test case, like in the out files
+def report_line(group, exercise, records):
+    test_groups = {}
+    for record in records:
+        test_groups[record["test_group"]] = test_groups.get(record["test_group"], False) or record["success"] == "pass"
+    return {
+        "group": group,
+        "exercise": exercise,
+        "run": records[0]["run"],
+        "passed": sum(1 for record in records if record["success"] == "pass"),
+        "tests": len(records),
+        "result": "+" if all(test_groups.values()) else "-",
+    }
+
+
+def merge(options):
+    paths = options.files or sorted(glob(SHARD_RESULTS_PATTERN))
+    if not paths:
+        print(col.FAIL, f"ERROR: no results files found matching {SHARD_RESULTS_PATTERN}", col.ENDC)
+        exit(1)
+    if any(os.path.abspath(path) == os.path.abspath(options.output) for path in paths):
+        print(col.FAIL, f"ERROR: {options.output} is one of the results files to merge, choose another output file",
+              col.ENDC)
+        exit(1)
+
+    records = []
+    for path in paths:
+        records += read_results(path)
+    merged = merge_records(records)
+
+    with open(options.output, "w", encoding="utf-8") as file:
+        for key in sorted(merged):
+            for record in merged[key]:
+                file.write(json.dumps(record, ensure_ascii=False) + "\n")
+
+    with open(options.report, "w", encoding="utf-8", newline="") as file:
+        writer = csv.DictWriter(file, fieldnames=["group", "exercise", "run", "passed", "tests", "result"])
+        writer.writeheader()
+        for group, exercise in sorted(merged):
+            writer.writerow(report_line(group, exercise, merged[(group, exercise)]))
+
+    print(f"Merged {len(records)} records from {len(paths)} file(s) into {options.output}, "
+          f"{len(merged)} group and exercise results written to {options.report}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Merges the results files of several shards or queue workers")
+    parser.add_argument("files", nargs="*",
+                        help=f"results files to merge (default: all files matching {SHARD_RESULTS_PATTERN})")
+    parser.add_argument("-o", "--output", default=MERGED_RESULTS_PATH,
+                        help=f"file to write the merged results to (default: {MERGED_RESULTS_PATH})")
+    parser.add_argument("--report", default=REPORT_PATH,
+                        help=f"file to write the report to (default: {REPORT_PATH})")
+    merge_options = parser.parse_args()
+
+    merge(merge_options)
+    print(col.OKGREEN, "Merge finished", col.ENDC)
@@ -0,0 +1,70 @@
+import threading
+from collections import defaultdict
+
+# SETTINGS
+SUMMARY_SIZE = 10       # Number of groups and tests listed in the summary
+
+
+# Timings of a number of runs of something: how often it ran, the total and longest time, and the inferences
+class Timing:
+    def __init__(self):
+        self.count = 0
+        self.time = 0.0
+        self.max_time = 0.0
+        self.inferences = 0
+
+    def add(self, time, inferences=0):
+        self.count += 1
+        self.time += time
+        self.max_time = max(self.max_time, time)
+        self.inferences += inferences
+
+
+# Collects the profiles of the runs of swipl, and summarizes them per group, per test case and per phase
+# A phase is a kind of step ("consult knowledge", "abolish", ...), all test goals are the phase "goal",
+# and "spawn" is the time of a run that was spent outside its steps (starting swipl or a job, and passing the job on)
+class Profiler:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.groups = defaultdict(Timing)
+        self.tests = defaultdict(Timing)
+        self.phases = defaultdict(Timing)
+
+    # Adds a run of swipl that took total seconds, steps is the profile reported for it
+    # Steps that ran a test case have its name in their "test" entry
+    def add_run(self, group, exercise, total, steps):
+        with self.lock:
+            self.groups[group].add(total)
+            for step in steps:
+                if "test" in step:
+                    self.tests[(exercise, step["test"])].add(step["time"], step["inferences"])
+                    self.phases["goal"].add(step["time"], step["inferences"])
+                else:
+                    self.phases[phase_name(step["step"])].add(step["time"], step["inferences"])
+            self.phases["spawn"].add(max(0.0, total - sum(step["time"] for step in steps)))
+
+    # The summary as a list of lines
+    def summary(self):
+        lines = ["Profile summary", "", f"Slowest groups (of {len(self.groups)}):"]
+        for group, timing in sorted(self.groups.items(), key=lambda x: -x[1].time)[:SUMMARY_SIZE]:
+            lines.append(f"  {str(group):<40}{timing.time:>10.3f}s in {timing.count} runs, "
+                         f"longest run {timing.max_time:.3f}s")
+
+        lines += ["", f"Slowest tests (of {len(self.tests)}):"]
+        for (exercise, test), timing in sorted(self.tests.items(), key=lambda x: -x[1].max_time)[:SUMMARY_SIZE]:
+            lines.append(f"  {f'{exercise}/{test}':<40}{timing.max_time:>10.3f}s at most, "
+                         f"{timing.time / timing.count:.3f}s and {timing.inferences // timing.count} inferences "
+                         f"on average over {timing.count} runs")
+
+        lines += ["", "Time per phase:"]
+        for phase, timing in sorted(self.phases.items(), key=lambda x: -x[1].time):
+            lines.append(f"  {phase:<40}{timing.time:>10.3f}s in {timing.count} steps, "
+                         f"{timing.inferences} inferences")
+        return lines
+
+
+# The phase of a step, calls are named after the goal they call, everything else after what the step does
+def phase_name(step):
+    if step.startswith("abolish "):
+        return "abolish"
+    return step
@@ -0,0 +1,264 @@
+from subprocess import Popen, PIPE, DEVNULL
+from collections import namedtuple
+from contextlib import contextmanager
+import json
+import os
+import queue
+import time
+import threading
+
+# PATH CONSTANTS
+WORKER_SOURCE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "prolog_worker.pl")
+SWIPL = "swipl"
+
+# SETTINGS
+KILL_GRACE = 5          # Seconds a job may overrun its time limit before the worker running it gets killed
+SESSION_STACK_LIMIT = "1m"  # Stack limit for loading the knowledge of a session
+
+# A unit of work for SWI-Prolog, all sources are plain prolog text and are loaded in this order:
+# pre, knowledge, (abolish the given predicates), database, test, after which the goal is called (if any)
+# The whole job gets time_limit seconds (0 means no limit), after which Prolog raises time_limit_exceeded
+# If profile is set, the worker reports how long every step of the job took
+PrologJob = namedtuple("PrologJob",
+                       ["knowledge", "pre", "abolish", "database", "test", "goal", "stack_limit", "time_limit",
+                        "profile"],
+                       defaults=["", [], "", "", "", "128k", 0, False])
+
+# What running a job gives back: the output and errors just like a commandline run of swipl would give,
+# the profile of the job: a dictionary with the step, time, cputime and inferences of every step (if profiled),
+# and the results: a dictionary with the id, output (a list of written strings) and duration (seconds) of every test
+# case that reported
+PrologResult = namedtuple("PrologResult", ["out", "err", "profile", "results"], defaults=[[], []])
+
+# What screening a source gives back: its errors just like consulting it would give,
+# the predicates it defines ("name/arity"), and those of the candidates that are provided by Prolog itself
+# complete is False if the source has directives that may define more predicates than it could see
+ScreenResult = namedtuple("ScreenResult", ["err", "predicates", "provided", "complete"], defaults=[True])
+
+# Error text reported for a job that had to be killed, matches what Prolog itself reports on time_limit_exceeded
+TIME_LIMIT_ERROR = "ERROR: Time limit exceeded, SWI-Prolog had to be killed\n"
+# Start of the error text reported for a job whose worker died or stopped answering properly, which says nothing about
+# the job itself
+WORKER_ERROR = "ERROR: Prolog worker failed"
+
+
+# Raised when a worker process dies or stops answering properly
+class WorkerError(Exception):
+    pass
+
+
+# Raised when a worker does not answer within the time limit of its job
+class WorkerTimeout(WorkerError):
+    pass
+
+
+# The time after which a job gets killed from the outside, None if it may run forever
+def kill_timeout(job):
+    if not job.time_limit:
+        return None
+    return job.time_limit + KILL_GRACE
+
+
+# Converts a swipl style size ("128k", "1m", "2g" or plain bytes) to a number of bytes
+def parse_size(size):
+    size = str(size).strip().lower()
+    units = {"k": 1024, "m": 1024 ** 2, "g": 1024 ** 3}
+    if size and size[-1] in units:
+        return int(size[:-1]) * units[size[-1]]
+    return int(size)
+
+
+# A single long-lived swipl process that runs jobs through prolog_worker.pl
+class PrologWorker:
+    def __init__(self):
+        self.process = None
+        self.last_id = 0
+        self.session_knowledge = None   # Knowledge that jobs may share, see session()
+        self.session_loaded = None      # Whether the session knowledge is loaded, None if that wasn't tried yet
+        self.session_err = ""           # The errors of loading the session knowledge
+        self.start()
+
+    def start(self):
+        self.process = Popen([SWIPL, "-q", "-g", "serve", "-t", "halt", WORKER_SOURCE],
+                             stdin=PIPE, stdout=PIPE, stderr=DEVNULL,
+                             encoding="utf-8", errors="ignore", bufsize=1)
+
+        # Output is read by a separate thread, so that waiting for a reply can time out
+        self.lines = queue.Queue()
+        threading.Thread(target=read_lines, args=(self.process.stdout, self.lines), daemon=True).start()
+
+    def restart(self, kill=False):
+        self.close(kill)
+        self.start()
+
+        # A new process has nothing loaded yet
+        if self.session_loaded:
+            self.session_loaded = None
+
+    # Keeps the given knowledge loaded for the jobs run in the with block, instead of loading it for every job
+    # The knowledge is loaded by the first job that uses it, jobs with other knowledge are run the usual way
+    @contextmanager
+    def session(self, knowledge):
+        self.session_knowledge = knowledge
+        self.session_loaded = None
+        try:
+            yield self
+        finally:
+            if self.session_loaded:
+                try:
+                    self.request("unload", {}, KILL_GRACE)
+                except WorkerError:
+                    self.restart(kill=True)
+            self.session_knowledge = None
+            self.session_loaded = None
+            self.session_err = ""
+
+    # Loads the session knowledge within the limits of the given job, sets whether that worked without errors
+    # Returns the profile of loading it
+    def load_session(self, job):
+        request = {"knowledge": self.session_knowledge, "stack_limit": parse_size(SESSION_STACK_LIMIT),
+                   "time_limit": job.time_limit, "profile": job.profile}
+        try:
+            reply = self.request("load", request, kill_timeout(job))
+        except WorkerTimeout:
+            self.restart(kill=True)
+            self.session_loaded, self.session_err = False, TIME_LIMIT_ERROR
+            return []
+        except WorkerError as e:
+            self.restart()
+            self.session_loaded, self.session_err = False, f"{WORKER_ERROR}: {e}\n"
+            return []
+        self.session_loaded, self.session_err = "ERROR" not in reply["err"], reply["err"]
+        return reply.get("profile", [])
+
+    # Loads the session knowledge within the limits of the given job, unless that was tried already
+    # Returns the errors of loading it, like consulting the knowledge would give them
+    def session_errors(self, job):
+        if self.session_knowledge is None:
+            return ""
+        if self.session_loaded is None:
+            self.load_session(job)
+        return self.session_err
+
+    # Runs a job, returns a PrologResult
+    def run(self, job):
+        request = job._asdict()
+        request["stack_limit"] = parse_size(job.stack_limit)
+        request["abolish"] = list(job.abolish)
+
+        # Knowledge with errors is never used as a session, so jobs still report those errors themselves
+        profile = []
+        if job.knowledge and job.knowledge == self.session_knowledge:
+            if self.session_loaded is None:
+                profile = self.load_session(job)
+            if self.session_loaded:
+                request["knowledge"] = ""
+                request["session"] = True
+        try:
+            reply = self.request("run", request, kill_timeout(job))
+        except WorkerTimeout:
+            # The job ignored its time limit inside Prolog, so the process has to go
+            self.restart(kill=True)
+            return PrologResult("", TIME_LIMIT_ERROR, profile)
+        except WorkerError as e:
+            # Whatever the job did to the worker, the next job gets a fresh one
+            self.restart()
+            return PrologResult("", f"{WORKER_ERROR}: {e}\n", profile)
+        return PrologResult(reply["out"], reply["err"], profile + reply.get("profile", []), reply.get("results", []))
+
+    # Screens the knowledge of a job without loading it, within its limits, returns a ScreenResult
+    # candidates is a list of predicates ("name/arity") to check whether Prolog itself provides them
+    def screen(self, job, candidates=()):
+        request = {"knowledge": job.knowledge, "candidates": list(candidates),
+                   "stack_limit": parse_size(job.stack_limit), "time_limit": job.time_limit}
+        try:
+            reply = self.request("screen", request, kill_timeout(job))
+        except WorkerTimeout:
+            self.restart(kill=True)
+            return ScreenResult(TIME_LIMIT_ERROR, [], [], False)
+        except WorkerError as e:
+            self.restart()
+            return ScreenResult(f"{WORKER_ERROR}: {e}\n", [], [], False)
+        return ScreenResult(reply["err"], reply.get("predicates", []), reply.get("provided", []),
+                            reply.get("complete", False))
+
+    def request(self, op, fields, timeout=None):
+        self.last_id += 1
+        request = dict(fields, op=op, id=self.last_id)
+        try:
+            self.process.stdin.write(json.dumps(request) + "\n")
+            self.process.stdin.flush()
+        except OSError:
+            raise WorkerError("Prolog worker is not accepting jobs anymore")
+        return self.read_reply(self.last_id, timeout)
+
+    # Replies are the only JSON objects carrying our request id, any other line is stray output and skipped
+    def read_reply(self, request_id, timeout=None):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            try:
+                line = self.lines.get(timeout=None if deadline is None else max(0, deadline - time.monotonic()))
+            except queue.Empty:
+                raise WorkerTimeout("Prolog worker did not answer in time")
+            if line == "":
+                raise WorkerError("Prolog worker exited unexpectedly")
+            try:
+                reply = json.loads(line)
+            except ValueError:
+                continue
+            if isinstance(reply, dict) and reply.get("id") == request_id:
+                return reply
+
+    def close(self, kill=False):
+        if self.process is None:
+            return
+        try:
+            if kill:
+                self.process.kill()
+            else:
+                self.process.stdin.close()
+            self.process.wait(timeout=5)
+        except Exception:
+            self.process.kill()
+            self.process.wait()
+        self.process = None
+
+
+# Moves lines from a stream to a queue, an empty string marks the end of the stream
+def read_lines(stream, lines):
+    for line in stream:
+        lines.put(line)
+    lines.put("")
+
+
+# A fixed number of workers, handed out to whoever needs one
+class WorkerPool:
+    def __init__(self, size=1):
+        self.idle = queue.Queue()
+        self.workers = []
+        for _ in range(max(1, size)):
+            worker = PrologWorker()
+            self.workers.append(worker)
+            self.idle.put(worker)
+
+    # Reserve a worker for a number of consecutive jobs
+    @contextmanager
+    def worker(self):
+        worker = self.idle.get()
+        try:
+            yield worker
+        finally:
+            self.idle.put(worker)
+
+    def run(self, job):
+        with self.worker() as worker:
+            return worker.run(job)
+
+    def screen(self, job, candidates=()):
+        with self.worker() as worker:
+            return worker.screen(job, candidates)
+
+    def close(self):
+        for worker in self.workers:
+            worker.close()
+        self.workers = []
@@ -0,0 +1,97 @@
+import re
+from bisect import bisect_right
+
+# Reads prolog sources the way swipl reads them, in a single pass over every source
+# Comments are removed, quoted atoms, strings and character codes are left alone, and every source keeps its
+# number of lines, so that a line of the knowledge of a group can be traced back to the file it came from
+
+# PATTERNS
+# Code without comments, quoted text included, followed by the comment or other token after it
+# Every match moves on, unless the source is at its end, so Python only handles the comments and slashes
+TOKEN_PATTERN = re.compile(r"""
+    (?P<plain>[^'"`%/\d]*(?:(?:                                 # Names, operators and layout, between the tokens below
+        /(?![*/])
+        |\d+(?![\d'])                                          # Most numbers
+        |0'(?:\\(?:x[0-9a-fA-F]*\\?|[0-7]+\\?|.)|''|[^.])      # A character code, like 0'a, 0'\n or 0''
+        |\d\w*'\w+                                             # A number in radix notation, like 16'FF
+        |'[^'\\]*(?:(?:\\.|'')[^'\\]*)*'                         # A quoted atom
+        |"[^"\\]*(?:(?:\\.|"")[^"\\]*)*"                         # A string
+        |`[^`\\]*(?:(?:\\.|``)[^`\\]*)*`                         # A code list
+    )[^'"`%/\d]*)*)
+    (?:(?P<line_comment>%[^\n]*)
+    |(?P<block_comment>/\*.*?\*/)
+    |(?P<slashes>//)
+    |(?P<code>0'\.)                                            # The character code of a ., which doesn't end a clause
+    |(?P<other>.)                                               # Anything else, like an unterminated quote or comment
+    )?
+""", re.VERBOSE | re.DOTALL)
+SYMBOL_CHARACTERS = "#$&*+-./:<=>?@^~\\"
+
+
+# Removes the comments from a prolog source, a comment is replaced by the line breaks it spans (or a space if it
+# doesn't span any), so that every line of code stays on the same line number
+# Lines starting with // where a clause would start are removed as well, as they're meant as comments but never parse
+def normalize_source(text):
+    # Most knowledge has no comments at all, which needs no tokenizing
+    if "%" not in text and "/*" not in text and "//" not in text:
+        return text
+
+    parts = []
+    position = 0
+    clause_start = True     # Whether a clause would start at position, after layout and comments
+    while position < len(text):
+        match = TOKEN_PATTERN.match(text, position)
+        position = match.end()
+
+        plain = match.group("plain")
+        if plain:
+            parts.append(plain)
+            clause_start = ends_clause(plain, clause_start)
+
+        kind = match.lastgroup
+        if kind == "plain" or kind == "line_comment":
+            continue
+        if kind == "block_comment":
+            parts.append("\n" * match.group(kind).count("\n") or " ")
+        elif kind == "slashes" and clause_start and text[match.start(kind) - 1:match.start(kind)] != ".":
+            # A . right before the slashes would be part of the same atom of symbol characters
+            end = text.find("\n", position)
+            position = len(text) if end == -1 else end
+        else:
+            # Slashes anywhere else are an operator, like in X // 2
+            # (see TOKEN_PATTERN for the others)
+            parts.append(match.group(kind))
+            clause_start = False
+    return "".join(parts)
+
+
+# Whether a clause would start after some plain code, given whether one would start before it
+# That's the case if it ends with the end of a clause: a . that is not part of an atom of symbol characters,
+# followed by layout or a comment
+def ends_clause(plain, clause_start):
+    stripped = plain.rstrip()
+    if not stripped:
+        return clause_start
+    return stripped[-1] == "." and (len(stripped) == 1 or stripped[-2] not in SYMBOL_CHARACTERS)
+
+
+# Which lines of the knowledge of a group came from which of its files
+# The knowledge is the sources of all files one after another, each followed by a line break (see join_sources)
+class LineMap:
+    def __init__(self):
+        self.starts = []    # The first line of every file in the knowledge, counting from 1
+        self.paths = []
+        self.lines = 1      # The first line after the files that were added so far
+
+    # Adds the next file of the knowledge, with the given source
+    def add(self, path, source):
+        self.starts.append(self.lines)
+        self.paths.append(path)
+        self.lines += source.count("\n") + 1
+
+    # Returns the file and the line in that file of a line of the knowledge, or None if it isn't in any file
+    def locate(self, line):
+        index = bisect_right(self.starts, line) - 1
+        if index < 0 or line >= self.lines:
+            return None
+        return self.paths[index], line - self.starts[index] + 1
@@ -0,0 +1,510 @@
+% Persistent SWI-Prolog worker, driven by prolog_pool.py
+% Protocol: the worker reads one JSON request per line from standard input, and answers every request with
+% a single JSON line on standard output (preceded by an empty line, in case something left a partial line behind)
+% Every job is loaded into its own temporary module, which is destroyed again once the job is done
+% Alternatively, the knowledge of a submission can be loaded once into a session module, jobs that ask for the session
+% then run in that module, and everything they change in it is undone again once they are done
+% A source can also be screened without loading it: its terms are only read, to find syntax errors and the predicates
+% it defines
+
+:- module(prolog_worker, [serve/0]).
+
+:- use_module(library(http/json)).
+:- use_module(library(memfile)).
+:- use_module(library(readutil)).
+:- use_module(library(time)).
+
+% Messages printed while a job runs are collected instead of being written to standard error
+:- thread_local collecting/0.
+:- thread_local collected/1.
+
+% When a job is profiled, every step it performs is timed: step_profile(Dict)
+:- thread_local profiling/0.
+:- thread_local step_profile/1.
+
+% What a job reported: reported(Id, Output, Duration), test cases report through checker_report/3 with the seconds
+% they took, anything else has null as its duration
+:- thread_local reported/3.
+
+% The predicates a screened source defines: screened(Name/Arity)
+% screened_open is there when the source has directives that may define predicates screening can't see
+:- thread_local screened/1.
+:- thread_local screened_open/0.
+
+% The loaded session: session(Module, Source), and the predicates its knowledge defined right after loading:
+% session_predicate(Module, Head, Generation, Dynamic, Clauses)
+:- dynamic session/2.
+:- dynamic session_predicate/5.
+
+:- multifile user:message_hook/3.
+:- dynamic user:message_hook/3.
+
+user:message_hook(_Term, Kind, Lines) :-
+    memberchk(Kind, [error, warning]),
+    collecting,
+    with_output_to(string(Text), print_message_lines(current_output, kind(Kind), Lines)),
+    assertz(collected(Text)).
+
+% Compiled tests hand the output of every test case to this predicate, see compile_test in main.py
+% It is kept apart from anything else the job writes, and sent back with the reply
+user:checker_report(Id, Output, Duration) :-
+    assertz(prolog_worker:reported(Id, Output, Duration)).
+
+
+% Main loop, stops when standard input is closed
+serve :-
+    set_stream(user_input, encoding(utf8)),
+    set_stream(user_output, encoding(utf8)),
+    repeat,
+    read_line_to_string(user_input, Line),
+    (   Line == end_of_file
+    ->  !
+    ;   catch(handle_line(Line), Error, reply_error(Line, Error)),
+        fail
+    ).
+
+handle_line(Line) :-
+    atom_json_dict(Line, Request, []),
+    get_dict(op, Request, Op),
+    atom_string(OpName, Op),
+    handle(OpName, Request, Reply),
+    send(Reply).
+
+% Always answer, even when the request itself was broken, so the caller never waits forever
+reply_error(Line, Error) :-
+    (   catch(atom_json_dict(Line, Request, []), _, fail),
+        get_dict(id, Request, Id)
+    ->  true
+    ;   Id = null
+    ),
+    format(string(Err), "ERROR: worker could not handle request: ~q~n", [Error]),
+    send(_{id:Id, out:"", err:Err}).
+
+send(Reply) :-
+    nl(user_output),
+    json_write_dict(user_output, Reply, [width(0)]),
+    nl(user_output),
+    flush_output(user_output).
+
+
+% Requests
+handle(ping, Request, _{id:Id, out:"pong", err:""}) :-
+    get_dict(id, Request, Id).
+handle(run, Request, _{id:Id, out:Out, err:Err, profile:Profile, results:Results}) :-
+    get_dict(id, Request, Id),
+    get_dict(stack_limit, Request, StackLimit),
+    get_dict(time_limit, Request, TimeLimit),
+    job_steps(Request, Steps),
+    (   get_dict(session, Request, true)
+    ->  session_job(Steps, TimeLimit, Job, Cleanup)
+    ;   Job = single(Steps, TimeLimit),
+        Cleanup = true
+    ),
+    call_cleanup(run_job_thread(Job, profiled(Request), StackLimit, Out, Err, Profile, Results),
+                 (maplist(free_step, Steps), Cleanup)).
+handle(load, Request, _{id:Id, out:Out, err:Err, profile:Profile}) :-
+    _{id:Id, knowledge:Knowledge, stack_limit:StackLimit, time_limit:TimeLimit} :< Request,
+    close_session,
+    format(atom(Module), "session_~w", [Id]),
+    load_step(Id, knowledge, Knowledge, Steps),
+    call_cleanup(run_job_thread(load(Steps, TimeLimit, Module), profiled(Request), StackLimit, Out, Err, Profile, _),
+                 maplist(free_step, Steps)),
+    forall(member(load(_, Source, _), Steps), assertz(session(Module, Source))),
+    save_session(Module).
+handle(unload, Request, _{id:Id, out:"", err:""}) :-
+    get_dict(id, Request, Id),
+    close_session.
+handle(screen, Request, _{id:Id, out:Out, err:Err, predicates:Predicates, provided:Provided, complete:Complete}) :-
+    _{id:Id, knowledge:Source, candidates:Candidates, stack_limit:StackLimit, time_limit:TimeLimit} :< Request,
+    run_job_thread(screen(Source, Candidates, TimeLimit), false, StackLimit, Out, Err, _, Results),
+    reported_value(predicates, Results, [], Predicates),
+    reported_value(provided, Results, [], Provided),
+    reported_value(complete, Results, false, Complete).
+
+reported_value(Id, Results, Default, Value) :-
+    (   member(Result, Results),
+        get_dict(id, Result, Id)
+    ->  get_dict(output, Result, Value)
+    ;   Value = Default
+    ).
+
+% The job runs in its own thread, so it gets its own stack limit and can not exhaust the worker itself
+% Profile is the list of step timings if the request asked for them, otherwise it is empty
+% Results is the list of what the test cases of the job reported
+run_job_thread(Job, Profiled, StackLimit, Out, Err, Profile, Results) :-
+    thread_self(Me),
+    thread_create(job(Job, Profiled, Me), Thread, [stack_limit(StackLimit)]),
+    thread_join(Thread, Status),
+    (   thread_peek_message(job_result(_, _, _, _))
+    ->  thread_get_message(job_result(Out, Err, Profile, Results))
+    ;   Out = "",
+        Profile = [],
+        Results = [],
+        format(string(Err), "ERROR: job thread ended with status ~q~n", [Status])
+    ).
+
+job(Job, Profiled, Parent) :-
+    assertz(collecting),
+    (   call(Profiled)
+    ->  assertz(profiling)
+    ;   true
+    ),
+    with_output_to(string(Out), run_job(Job)),
+    findall(Text, collected(Text), Texts),
+    atomic_list_concat(Texts, Err),
+    findall(Step, step_profile(Step), Profile),
+    findall(_{id:Id, output:Output, duration:Duration}, reported(Id, Output, Duration), Results),
+    thread_send_message(Parent, job_result(Out, Err, Profile, Results)).
+
+profiled(Request) :-
+    get_dict(profile, Request, true).
+
+run_job(single(Steps, TimeLimit)) :-
+    in_temporary_module(Module, true, prolog_worker:run_job(Steps, TimeLimit, Module)).
+run_job(session(Steps, TimeLimit, Module)) :-
+    run_job(Steps, TimeLimit, session(Module)).
+run_job(load(Steps, TimeLimit, Module)) :-
+    (   catch(limit_time(TimeLimit, run_steps(Steps, Module)), Error, (print_message(error, Error), fail))
+    ->  true
+    ;   true
+    ).
+run_job(no_session) :-
+    print_message(error, format("No session loaded", [])).
+run_job(screen(Source, Candidates, TimeLimit)) :-
+    (   catch(limit_time(TimeLimit, in_temporary_module(Module, true, prolog_worker:screen_source(Source, Module))),
+              Error, (print_message(error, Error), fail))
+    ->  true
+    ;   true
+    ),
+    findall(Text, (screened(Name/Arity), format(string(Text), "~w/~w", [Name, Arity])), Texts),
+    sort(Texts, Predicates),
+    assertz(reported(predicates, Predicates, null)),
+    include(provided, Candidates, Provided),
+    assertz(reported(provided, Provided, null)),
+    (   screened_open
+    ->  assertz(reported(complete, false, null))
+    ;   assertz(reported(complete, true, null))
+    ).
+
+% Mirrors "swipl -g Step1,Step2,... -t halt": the first failing or raising step ends the job
+% A time limit of 0 means the job may run as long as it likes
+run_job(Steps, TimeLimit, Module) :-
+    (   catch(limit_time(TimeLimit, run_steps(Steps, Module)), Error, (print_message(error, Error), fail))
+    ->  true
+    ;   true
+    ),
+    forall(member(load(_, Source, _), Steps), catch(unload_file(Source), _, true)).
+
+limit_time(TimeLimit, Goal) :-
+    TimeLimit =:= 0,
+    !,
+    call(Goal).
+limit_time(TimeLimit, Goal) :-
+    call_with_time_limit(TimeLimit, Goal).
+
+run_steps([], _).
+run_steps([Step|Steps], Module) :-
+    profile_step(Step, Module),
+    run_steps(Steps, Module).
+
+% Records the wall time, cpu time and inferences a step took, whether it succeeds, fails or raises
+profile_step(Step, Module) :-
+    \+ profiling,
+    !,
+    run_step(Step, Module).
+profile_step(Step, Module) :-
+    statistics(inferences, Inferences0),
+    statistics(cputime, CPU0),
+    get_time(Wall0),
+    (   catch(run_step(Step, Module), Error, true)
+    ->  Succeeded = true
+    ;   Succeeded = false
+    ),
+    statistics(inferences, Inferences1),
+    statistics(cputime, CPU1),
+    get_time(Wall1),
+    step_name(Step, Name),
+    Inferences is Inferences1 - Inferences0,
+    CPU is CPU1 - CPU0,
+    Wall is Wall1 - Wall0,
+    assertz(step_profile(_{step:Name, time:Wall, cputime:CPU, inferences:Inferences})),
+    (   nonvar(Error)
+    ->  throw(Error)
+    ;   Succeeded == true
+    ).
+
+step_name(load(Name, _, _), Text) :-
+    format(string(Text), "consult ~w", [Name]).
+step_name(abolish(PI), Text) :-
+    format(string(Text), "abolish ~q", [PI]).
+step_name(call(Goal), Text) :-
+    format(string(Text), "call ~q", [Goal]).
+
+% Within a session, the pre-knowledge only supplies the predicates that the knowledge doesn't define itself
+run_step(load(pre, Source, MemFile), session(Module)) :-
+    !,
+    in_temporary_module(Pre, true, prolog_worker:load_fallbacks(Source, MemFile, Pre, Module)).
+run_step(Step, session(Module)) :-
+    !,
+    run_step(Step, Module).
+run_step(load(_, Source, MemFile), Module) :-
+    load_source(Source, MemFile, Module).
+run_step(abolish(PI), Module) :-
+    abolish(Module:PI).
+run_step(call(Goal), Module) :-
+    (   call(Module:Goal)
+    ->  true
+    ;   print_message(warning, format("Goal (~q) failed", [Goal])),
+        fail
+    ).
+
+load_source(Source, MemFile, Module) :-
+    setup_call_cleanup(open_memory_file(MemFile, read, In),
+                       load_files(Module:Source, [stream(In)]),
+                       close(In)).
+
+load_fallbacks(Source, MemFile, Pre, Module) :-
+    load_source(Source, MemFile, Pre),
+    forall(( local_predicate(Pre, Head),
+             \+ local_predicate(Module, Head)
+           ),
+           forall(clause(Pre:Head, Body), assertz(Module:(Head :- Body)))),
+    catch(unload_file(Source), _, true).
+
+
+% Sessions
+% Loading the knowledge of a session in a job thread is the same as loading it for a single job, but it stays loaded
+% Right after loading, all clauses of the session module are saved, so they can be put back after every job
+
+session_job(Steps, TimeLimit, session(Steps, TimeLimit, Module), restore_session(Module)) :-
+    session(Module, _),
+    !.
+session_job(_, _, no_session, true).
+
+close_session :-
+    forall(retract(session(Module, Source)),
+           (   catch(unload_file(Source), _, true),
+               findall(Head, local_predicate(Module, Head), Heads),
+               maplist(abolish_head(Module), Heads),
+               retractall(session_predicate(Module, _, _, _, _))
+           )).
+
+save_session(Module) :-
+    forall(local_predicate(Module, Head), save_predicate(Module, Head)).
+
+save_predicate(Module, Head) :-
+    findall((Head :- Body), clause(Module:Head, Body), Clauses),
+    (   predicate_property(Module:Head, dynamic)
+    ->  Dynamic = true
+    ;   Dynamic = false
+    ),
+    predicate_property(Module:Head, last_modified_generation(Generation)),
+    assertz(session_predicate(Module, Head, Generation, Dynamic, Clauses)).
+
+% Removes everything a job added to the session module, and puts back the predicates of the knowledge it changed
+restore_session(Module) :-
+    findall(Head,
+            ( local_predicate(Module, Head),
+              \+ session_predicate(Module, Head, _, _, _)
+            ),
+            Added),
+    maplist(abolish_head(Module), Added),
+    forall(session_predicate(Module, Head, Generation, Dynamic, Clauses),
+           restore_predicate(Module, Head, Generation, Dynamic, Clauses)).
+
+restore_predicate(Module, Head, Generation, _, _) :-
+    local_predicate(Module, Head),
+    predicate_property(Module:Head, last_modified_generation(Generation)),
+    !.
+restore_predicate(Module, Head, Generation, Dynamic, Clauses) :-
+    abolish_head(Module, Head),
+    functor(Head, Name, Arity),
+    (   Dynamic == true
+    ->  dynamic(Module:Name/Arity),
+        forall(member(Clause, Clauses), assertz(Module:Clause))
+    ;   forall(member(Clause, Clauses), assertz(Module:Clause)),
+        compile_predicates([Module:Name/Arity])
+    ),
+    predicate_property(Module:Head, last_modified_generation(NewGeneration)),
+    retract(session_predicate(Module, Head, Generation, Dynamic, Clauses)),
+    assertz(session_predicate(Module, Head, NewGeneration, Dynamic, Clauses)).
+
+% Predicates defined in the module itself, not the ones it imports or inherits
+local_predicate(Module, Head) :-
+    current_predicate(_, Module:Head),
+    \+ predicate_property(Module:Head, imported_from(_)).
+
+abolish_head(Module, Head) :-
+    functor(Head, Name, Arity),
+    catch(abolish(Module:Name/Arity), _, true).
+
+
+% Screening
+% Every term of the source is read, but nothing is loaded: syntax errors are printed as errors, which end up in the
+% errors of the job, and the heads of clauses, DCG rules and dynamic declarations are the predicates it defines
+% Operator declarations are followed, so that the rest of the source is read the way consulting it would
+% Any other directive that runs code (like :- assert(...)) may define more predicates, the list is then incomplete
+
+screen_source(Source, Module) :-
+    setup_call_cleanup(open_string(Source, In),
+                       screen_terms(In, Module),
+                       close(In)).
+
+% The reader skips past a term with a syntax error, if it can't get any further the rest of the source is skipped
+screen_terms(In, Module) :-
+    character_count(In, Start),
+    catch(read_term(In, Term, [module(Module), syntax_errors(error)]), Error, true),
+    (   nonvar(Error)
+    ->  print_message(error, Error),
+        character_count(In, End),
+        (   End > Start
+        ->  screen_terms(In, Module)
+        ;   true
+        )
+    ;   Term == end_of_file
+    ->  true
+    ;   screen_term(Term, Module),
+        screen_terms(In, Module)
+    ).
+
+screen_term((:- Directive), Module) :-
+    !,
+    screen_directive(Directive, Module).
+screen_term((?- _), _) :-
+    !.
+screen_term((Head --> _), _) :-
+    !,
+    dcg_head(Head, Name, Arity),
+    DCGArity is Arity + 2,
+    assertz(screened(Name/DCGArity)).
+screen_term((Head :- _), _) :-
+    !,
+    screen_head(Head).
+screen_term(Head, _) :-
+    screen_head(Head).
+
+dcg_head((Head, _), Name, Arity) :-
+    !,
+    dcg_head(Head, Name, Arity).
+dcg_head(_:Head, Name, Arity) :-
+    !,
+    dcg_head(Head, Name, Arity).
+dcg_head(Head, Name, Arity) :-
+    callable(Head),
+    functor(Head, Name, Arity).
+
+% Clauses for built-in predicates would be refused when loading, so they are reported the same way
+screen_head(_:Head) :-
+    !,
+    screen_head(Head).
+screen_head(Head) :-
+    callable(Head),
+    !,
+    functor(Head, Name, Arity),
+    (   predicate_property(system:Head, built_in)
+    ->  print_message(error, error(permission_error(modify, static_procedure, Name/Arity), _))
+    ;   assertz(screened(Name/Arity))
+    ).
+screen_head(Head) :-
+    print_message(error, error(type_error(callable, Head), _)).
+
+screen_directive(op(Priority, Type, Names), Module) :-
+    !,
+    catch(op(Priority, Type, Module:Names), Error, print_message(error, Error)).
+screen_directive(dynamic(Spec), _) :-
+    !,
+    screen_declared(Spec).
+screen_directive(Directive, _) :-
+    declaration(Directive),
+    !.
+screen_directive(_, _) :-
+    (   screened_open
+    ->  true
+    ;   assertz(screened_open)
+    ).
+
+% Directives that only declare something, and can't define predicates
+declaration(discontiguous(_)).
+declaration(multifile(_)).
+declaration(module(_, _)).
+declaration(set_prolog_flag(_, _)).
+declaration(style_check(_)).
+declaration(table(_)).
+declaration(encoding(_)).
+declaration(use_module(library(_))).
+declaration(use_module(library(_), _)).
+declaration(ensure_loaded(library(_))).
+
+screen_declared(Var) :-
+    var(Var),
+    !.
+screen_declared((Spec1, Spec2)) :-
+    !,
+    screen_declared(Spec1),
+    screen_declared(Spec2).
+screen_declared(Specs) :-
+    is_list(Specs),
+    !,
+    maplist(screen_declared, Specs).
+screen_declared(_:Spec) :-
+    !,
+    screen_declared(Spec).
+screen_declared(Name/Arity) :-
+    atom(Name),
+    integer(Arity),
+    !,
+    assertz(screened(Name/Arity)).
+screen_declared(_).
+
+% Whether a predicate ("name/arity") is provided by Prolog itself, as a built-in or through its libraries
+provided(Candidate) :-
+    catch(term_string(Name/Arity, Candidate), _, fail),
+    atom(Name),
+    integer(Arity),
+    functor(Head, Name, Arity),
+    (   predicate_property(system:Head, defined)
+    ->  true
+    ;   catch('$in_library'(Name, Arity, _), _, fail)
+    ).
+
+
+% Turns a request into the list of steps to perform, in the same order the commandline runner uses
+job_steps(Request, Steps) :-
+    _{id:Id, pre:Pre, knowledge:Knowledge, abolish:Abolish, database:Database, test:Test, goal:Goal} :< Request,
+    load_step(Id, pre, Pre, S1),
+    load_step(Id, knowledge, Knowledge, S2),
+    maplist(abolish_step, Abolish, S3),
+    load_step(Id, database, Database, S4),
+    load_step(Id, test, Test, S5),
+    goal_step(Goal, S6),
+    append([S1, S2, S3, S4, S5, S6], Steps).
+
+% Sources are handed to the job thread as memory files, so they don't count against the job's stack limit
+load_step(_, _, "", []) :- !.
+load_step(Id, Name, Text, [load(Name, Source, MemFile)]) :-
+    format(atom(Source), "job_~w_~w", [Id, Name]),
+    new_memory_file(MemFile),
+    setup_call_cleanup(open_memory_file(MemFile, write, Out),
+                       write(Out, Text),
+                       close(Out)).
+
+abolish_step(Spec, abolish(PI)) :-
+    term_string(PI, Spec).
+
+% Every goal of a conjunction is a step of its own, so that each of them can be profiled
+goal_step("", []) :- !.
+goal_step(Text, Steps) :-
+    term_string(Goal, Text),
+    conjunction_steps(Goal, Steps).
+
+conjunction_steps((Goal1, Goal2), Steps) :-
+    !,
+    conjunction_steps(Goal1, Steps1),
+    conjunction_steps(Goal2, Steps2),
+    append(Steps1, Steps2, Steps).
+conjunction_steps(Goal, [call(Goal)]).
+
+free_step(load(_, _, MemFile)) :-
+    !,
+    free_memory_file(MemFile).
+free_step(_).
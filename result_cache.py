@@ -0,0 +1,79 @@
+import hashlib
+import json
+import os
+import tempfile
+
+# SETTINGS
+CACHE_VERSION = 2       # Bump whenever the meaning of an entry changes, so that old entries are never used again
+
+
+# Hashes the given parts into a key, parts can be anything JSON can represent
+def make_key(*parts):
+    data = json.dumps([CACHE_VERSION, *parts], sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(data.encode("utf-8")).hexdigest()
+
+
+# On-disk cache of results, every entry is a small JSON file named after its key
+# Entries are spread over subdirectories named after the first two characters of the key
+# Once the cache grows beyond max_size bytes, the least recently used entries are removed
+class ResultCache:
+    def __init__(self, path, max_size=100 * 1024 ** 2):
+        self.path = path
+        self.max_size = max_size
+        os.makedirs(self.path, exist_ok=True)
+
+    def entry_path(self, key):
+        return os.path.join(self.path, key[:2], key + ".json")
+
+    # Returns the value stored for the key, None if there is none
+    def get(self, key):
+        path = self.entry_path(key)
+        try:
+            with open(path, "r", encoding="utf-8") as file:
+                value = json.load(file)
+        except (OSError, ValueError):
+            return None
+
+        # Mark the entry as recently used, so that eviction keeps it around
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        return value
+
+    def put(self, key, value):
+        path = self.entry_path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        # Written to a temporary file first, so that nobody ever reads a half-written entry
+        fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w", encoding="utf-8") as file:
+                json.dump(value, file, ensure_ascii=False)
+            os.replace(temp_path, path)
+        except OSError:
+            try:
+                os.remove(temp_path)
+            except OSError:
+                pass
+
+    # Removes the least recently used entries until the cache fits in max_size again
+    def evict(self):
+        entries = []
+        for directory in os.scandir(self.path):
+            if not directory.is_dir():
+                continue
+            for entry in os.scandir(directory.path):
+                if entry.name.endswith(".json"):
+                    stat = entry.stat()
+                    entries.append((stat.st_mtime, stat.st_size, entry.path))
+
+        size = sum(entry[1] for entry in entries)
+        for _, entry_size, path in sorted(entries):
+            if size <= self.max_size:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            size -= entry_size
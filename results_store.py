@@ -0,0 +1,27 @@
+import json
+import threading
+
+
+# Append-only store of test results, every record is written as a single JSON line as soon as it is added
+# Records may be added from several threads at once
+class ResultsStore:
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.file = open(path, "a", encoding="utf-8")
+
+    def add(self, record):
+        line = json.dumps(record, ensure_ascii=False) + "\n"
+        with self.lock:
+            self.file.write(line)
+            self.file.flush()
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+
+# Reads all records from a results file, in the order they were added
+def read_results(path):
+    with open(path, "r", encoding="utf-8") as file:
+        return [json.loads(line) for line in file if line.strip()]
@@ -0,0 +1,9 @@
+from json_store import MergedJsonStore
+
+
+# Remembers how long grading every (group, exercise) pair took the last time it was run,
+# and whether its composed test failed so that its test cases had to be narrowed down
+# get returns a dictionary with keys: duration (seconds), fallback (bool), or None if it was never run
+class RunTimes(MergedJsonStore):
+    def set(self, group, exercise, duration, fallback):
+        self.put(group, exercise, {"duration": round(duration, 3), "fallback": fallback})
@@ -0,0 +1,95 @@
+import hashlib
+import json
+import os
+import re
+from glob import glob, escape as glob_escape
+
+
+# A queue of jobs in a directory, which several processes, also on several machines, can take jobs from
+# Every job is a file that moves from todo/ to claimed/<worker>/ to done/ while it is worked on
+# Claiming a job is renaming its file, which only one process can do, also on a shared (NFS) directory
+# The jobs of a worker that stopped halfway stay in its claimed folder, moving them back to todo/ runs them again
+# A job that is done is added again when its "inputs" changed, so the same queue can be used for every run
+class WorkQueue:
+    def __init__(self, path, worker):
+        self.path = path
+        self.worker = worker
+        self.costs = {}
+        for folder in [os.path.join(path, "todo"), os.path.join(path, "claimed", worker), os.path.join(path, "done")]:
+            os.makedirs(folder, exist_ok=True)
+
+    def todo_path(self, job_id):
+        return os.path.join(self.path, "todo", f"{job_id}.json")
+
+    def claimed_path(self, job_id):
+        return os.path.join(self.path, "claimed", self.worker, f"{job_id}.json")
+
+    def done_path(self, job_id):
+        return os.path.join(self.path, "done", f"{job_id}.json")
+
+    # Adds a job, unless it is in the queue already (to do, claimed, or done with the same inputs),
+    # returns whether it was added
+    # The job is written next to the queue first, so that it can't be claimed before it is complete
+    def add(self, job_id, data):
+        if glob(os.path.join(glob_escape(self.path), "claimed", "*", f"{glob_escape(job_id)}.json")):
+            return False
+        done = read_job(self.done_path(job_id))
+        if done is not None:
+            if done.get("inputs") == data.get("inputs"):
+                return False
+            try:
+                os.remove(self.done_path(job_id))
+            except FileNotFoundError:
+                pass
+
+        temp_path = os.path.join(self.path, f".{job_id}.{self.worker}.tmp")
+        with open(temp_path, "w", encoding="utf-8") as file:
+            json.dump(data, file)
+        try:
+            os.link(temp_path, self.todo_path(job_id))
+            return True
+        except FileExistsError:
+            return False
+        finally:
+            os.remove(temp_path)
+
+    # Claims the next job, returns its id and data, or None if there are no jobs left to do
+    # Jobs with the highest "cost" in their data are claimed first, the cost of every job is only read once
+    def claim(self):
+        names = [name for name in os.listdir(os.path.join(self.path, "todo")) if name.endswith(".json")]
+        for job_id in sorted((name[:-len(".json")] for name in names), key=lambda job_id: (-self.cost(job_id), job_id)):
+            try:
+                os.rename(self.todo_path(job_id), self.claimed_path(job_id))
+            except (FileNotFoundError, FileExistsError):
+                # Someone else claimed it first
+                continue
+            with open(self.claimed_path(job_id), "r", encoding="utf-8") as file:
+                return job_id, json.load(file)
+        return None
+
+    # The cost of a job that is still to do, 0 if it has none or was claimed in the meantime
+    def cost(self, job_id):
+        if job_id not in self.costs:
+            try:
+                with open(self.todo_path(job_id), "r", encoding="utf-8") as file:
+                    self.costs[job_id] = json.load(file).get("cost", 0)
+            except (OSError, ValueError):
+                return 0
+        return self.costs[job_id]
+
+    def finish(self, job_id):
+        os.replace(self.claimed_path(job_id), self.done_path(job_id))
+
+
+# Reads the data of a job, None if it isn't there (anymore)
+def read_job(path):
+    try:
+        with open(path, "r", encoding="utf-8") as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return None
+
+
+# A job id for a name that may contain anything, that is still readable and safe to use as a file name
+def job_id(name):
+    return f"{re.sub(r'[^A-Za-z0-9_-]+', '_', name)[:60]}-{hashlib.sha256(name.encode('utf-8')).hexdigest()[:12]}"